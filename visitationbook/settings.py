@@ -162,6 +162,10 @@ LOGGING = {
             'handlers': ['console'],
             'level': 'DEBUG',
         },
+        'visitationbookapi': {
+            'handlers': ['console'],
+            'level': os.environ.get('VISITATIONBOOK_LOG_LEVEL', 'INFO'),
+        },
     },
 }
 
@@ -470,7 +474,68 @@ EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS')
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD')
 DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL')
+# Outbox : emails envoyés hors requête par `send_queued_emails`, sur une connexion SMTP réutilisée
+# Nombre d'emails réservés (et envoyés sur une même connexion) à chaque passage
+EMAIL_OUTBOX_BATCH_SIZE = int(os.environ.get('EMAIL_OUTBOX_BATCH_SIZE', 50))
+# Intervalle (secondes) entre deux scrutations de l'outbox
+EMAIL_OUTBOX_POLL_INTERVAL = float(os.environ.get('EMAIL_OUTBOX_POLL_INTERVAL', 2))
+# Nombre d'essais avant abandon, délai (secondes) avant le premier nouvel essai, doublé ensuite
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('EMAIL_OUTBOX_MAX_ATTEMPTS', 8))
+EMAIL_OUTBOX_RETRY_DELAY = int(os.environ.get('EMAIL_OUTBOX_RETRY_DELAY', 60))
+# Durée (secondes) au-delà de laquelle un email `sending` est considéré abandonné et repris
+EMAIL_OUTBOX_SENDING_TIMEOUT = int(os.environ.get('EMAIL_OUTBOX_SENDING_TIMEOUT', 600))
+# Taille maximale (octets, pièces jointes encodées comprises) d'un email placé dans l'outbox ;
+# le relais SMTP refuse les messages trop gros. 0 : sans limite
+EMAIL_MAX_MESSAGE_BYTES = int(os.environ.get('EMAIL_MAX_MESSAGE_BYTES', 10 * 1024 * 1024))
+# Images jointes par les familles : plus grand côté (pixels) et qualité JPEG après réduction
+EMAIL_IMAGE_MAX_SIZE = int(os.environ.get('EMAIL_IMAGE_MAX_SIZE', 1600))
+EMAIL_IMAGE_JPEG_QUALITY = int(os.environ.get('EMAIL_IMAGE_JPEG_QUALITY', 80))
 
 stripe.api_key = os.environ.get('STRIPE_TEST_SECRET_KEY')
 
 
+# PDF rendering
+# Durée (secondes) au-delà de laquelle un job `running` est considéré abandonné et repris
+PDF_RENDER_JOB_TIMEOUT = int(os.environ.get('PDF_RENDER_JOB_TIMEOUT', 600))
+# Intervalle (secondes) entre deux scrutations de la file par `run_pdf_worker`
+PDF_RENDER_POLL_INTERVAL = float(os.environ.get('PDF_RENDER_POLL_INTERVAL', 2))
+# Fenêtre (secondes) pendant laquelle les demandes de rendu d'un même livre sont regroupées
+PDF_RENDER_COALESCE_WINDOW = float(os.environ.get('PDF_RENDER_COALESCE_WINDOW', 30))
+# Rendu immédiat (via la file) du PDF d'impression à chaque écriture ; sinon il est rendu à la demande uniquement
+PDF_EAGER_RENDER = int(os.environ.get('PDF_EAGER_RENDER', 0))
+# Rendu immédiat (via la file) du PDF web, léger, à chaque écriture
+PDF_WEB_EAGER_RENDER = int(os.environ.get('PDF_WEB_EAGER_RENDER', 1))
+# Au-delà de ce nombre de visiteurs, le livre est rendu en plusieurs volumes d'au plus autant de
+# visiteurs (arrondi à une page pleine) : mémoire et durée de rendu bornées par volume. 0 : jamais.
+# Désactivé par défaut : pdf_file et le téléchargement sans ?volume ne désignent alors que le premier volume
+PDF_VOLUME_MAX_GUESTS = int(os.environ.get('PDF_VOLUME_MAX_GUESTS', 0))
+# Cache des segments (couverture, pages de visiteurs) du visitation book
+PDF_SEGMENT_CACHE_DIR = os.environ.get('PDF_SEGMENT_CACHE_DIR', os.path.join(MEDIA_ROOT, 'pdf_segments'))
+# À incrémenter quand un changement hors template (logique de rendu, CSS partagé...) modifie les PDF
+PDF_TEMPLATE_VERSION = os.environ.get('PDF_TEMPLATE_VERSION', '1')
+# Résolution des images embarquées dans les PDF et dossier de leurs dérivés (doit rester sous MEDIA_ROOT)
+PDF_IMAGE_DPI = int(os.environ.get('PDF_IMAGE_DPI', 300))
+PDF_WEB_IMAGE_DPI = int(os.environ.get('PDF_WEB_IMAGE_DPI', 96))
+PDF_IMAGE_CACHE_DIR = os.environ.get('PDF_IMAGE_CACHE_DIR', os.path.join(MEDIA_ROOT, 'pdf_images'))
+# Vignettes des pages du PDF web : largeur (pixels), format Pillow et dossier (doit rester sous MEDIA_ROOT)
+PDF_PREVIEW_WIDTH = int(os.environ.get('PDF_PREVIEW_WIDTH', 360))
+PDF_PREVIEW_FORMAT = os.environ.get('PDF_PREVIEW_FORMAT', 'WEBP')
+PDF_PREVIEW_CACHE_DIR = os.environ.get('PDF_PREVIEW_CACHE_DIR', os.path.join(MEDIA_ROOT, 'pdf_previews'))
+# Nombre de processus du pool de rendu WeasyPrint de chaque processus web (0 : rendu dans le processus appelant) ;
+# petit car chaque worker gunicorn démarre son propre pool et les rendus se font dans run_pdf_worker
+PDF_RENDER_POOL_SIZE = int(os.environ.get('PDF_RENDER_POOL_SIZE', 1))
+# Rendus simultanés (et processus de rendu) de run_pdf_worker et rebuild_book_pdfs : valeur par défaut de leur --concurrency
+PDF_WORKER_POOL_SIZE = int(os.environ.get('PDF_WORKER_POOL_SIZE', os.cpu_count() or 1))
+# Limites de chaque processus de rendu : mémoire (Mio, espace d'adressage) et temps CPU par rendu
+# (secondes) ; au-delà, le rendu échoue proprement et l'erreur est enregistrée sur le livre. 0 : sans limite
+PDF_RENDER_MEMORY_LIMIT = int(os.environ.get('PDF_RENDER_MEMORY_LIMIT', 2048))
+PDF_RENDER_CPU_LIMIT = int(os.environ.get('PDF_RENDER_CPU_LIMIT', 120))
+# Notes de remerciement rendues par `run_pdf_worker` : nombre de guests d'un livre réservés à chaque
+# passage, et durée (secondes) au-delà de laquelle un rendu `rendering` est considéré abandonné et repris
+THANK_YOU_BATCH_SIZE = int(os.environ.get('THANK_YOU_BATCH_SIZE', 50))
+THANK_YOU_RENDER_TIMEOUT = int(os.environ.get('THANK_YOU_RENDER_TIMEOUT', 600))
+# Durée de validité (secondes) des liens signés vers le PDF de remerciement, pour les livres
+# qui envoient un lien plutôt qu'une pièce jointe
+THANK_YOU_LINK_MAX_AGE = int(os.environ.get('THANK_YOU_LINK_MAX_AGE', 90 * 24 * 3600))
+# Jeton (Bearer) exigé par l'endpoint des métriques PDF ; vide : accès libre (réseau interne)
+PDF_METRICS_TOKEN = os.environ.get('PDF_METRICS_TOKEN', '')
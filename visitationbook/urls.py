@@ -54,6 +54,7 @@ urlpatterns = [
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('api/token/verify/', TokenVerifyView.as_view(), name='token_verify'),
     path('api/auth/me/', UserDetailView.as_view(), name='user_detail'),
+    path('metrics/pdf/', PdfMetricsView.as_view(), name='pdf_metrics'),
     
     # AllAuth URLs (nécessaire pour l'authentification sociale)
     path('accounts/', include('allauth.urls')),
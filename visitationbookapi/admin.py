@@ -72,9 +72,41 @@ class BookPurchaseAdmin(ImportExportModelAdmin):
 
 @admin.register(GuestInfo)
 class GuestInfoAdmin(ImportExportModelAdmin):
-    list_display = ('id', 'book_purchase', 'guest_name', 'guest_email')
+    list_display = ('id', 'book_purchase', 'guest_name', 'guest_email', 'thank_you_status')
+    list_filter = ('thank_you_status',)
     search_fields = ('id', 'guest_name', 'guest_email')
-    readonly_fields = ('id',)
+    readonly_fields = ('id', 'thank_you_requested_at', 'thank_you_started_at', 'thank_you_email', 'thank_you_error')
+
+@admin.register(PdfRenderJob)
+class PdfRenderJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'book_purchase', 'profile', 'status', 'created_at', 'started_at', 'finished_at', 'duration', 'coalesced_requests')
+    list_filter = ('status', 'profile')
+    search_fields = ('id', 'book_purchase__id', 'book_purchase__deceased_name')
+    readonly_fields = ('id', 'created_at', 'run_after', 'started_at', 'finished_at', 'duration', 'coalesced_requests', 'error')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('book_purchase')
+
+class OutboxAttachmentInline(admin.TabularInline):
+    model = OutboxAttachment
+    fields = ('filename', 'mimetype', 'content_id', 'file')
+    readonly_fields = fields
+    extra = 0
+
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'subject', 'status', 'attempts', 'created_at', 'next_attempt_at', 'sent_at')
+    list_filter = ('status', 'kind')
+    search_fields = ('id', 'subject', 'to')
+    readonly_fields = ('id', 'created_at', 'attempts', 'started_at', 'sent_at', 'error')
+    inlines = [OutboxAttachmentInline]
+    actions = ['retry']
+
+    @admin.action(description="Send again")
+    def retry(self, request, queryset):
+        queryset = queryset.exclude(status='sent')
+        GuestInfo.objects.filter(thank_you_email__in=queryset, thank_you_status='failed').update(thank_you_status='queued', thank_you_error=None)
+        queryset.update(status='queued', attempts=0, next_attempt_at=None)
 
 @admin.register(Obituary)
 class ObituaryAdmin(ImportExportModelAdmin):
@@ -0,0 +1,272 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from visitationbook import settings
+from visitationbookapi.models import User, Book, BookPurchase, GuestInfo
+from visitationbookapi.utils import generate_pdf, generate_thank_you_note_pdf, submit_pdf_render
+from PIL import Image
+import os
+import sys
+import json
+import uuid
+import time
+import shutil
+import datetime
+import tempfile
+import threading
+import psutil
+
+
+class PeakRssSampler(threading.Thread):
+    """Échantillonne la mémoire résidente du processus et de ses enfants (pool de rendu)"""
+
+    def __init__(self, interval=0.02):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+        self.sample()
+        self.baseline = self.peak
+
+    def sample(self):
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        self.peak = max(self.peak, rss)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+        return self.peak
+
+
+def io_counters():
+    """
+    Octets lus et écrits par le processus et ses enfants : les rendus WeasyPrint et les
+    dérivés d'images se font dans les processus du pool de rendu.
+    read_chars/write_chars incluent les accès servis par le cache du noyau.
+    """
+    process = psutil.Process()
+    read = written = 0
+    for proc in [process, *process.children(recursive=True)]:
+        try:
+            counters = proc.io_counters()
+        except psutil.Error:
+            continue
+        read += getattr(counters, 'read_chars', counters.read_bytes)
+        written += getattr(counters, 'write_chars', counters.write_bytes)
+    return read, written
+
+
+class Command(BaseCommand):
+    help = 'Measure wall time, peak memory and disk I/O of the PDF renderers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('book_purchase_id', nargs='?', help='Id of the book purchase to render')
+        parser.add_argument('--synthetic', action='store_true', help='Render synthetic books instead of an existing one (rolled back afterwards)')
+        parser.add_argument('--guests', default='0,10,100,1000', help='Comma separated guest counts of the synthetic books')
+        parser.add_argument('--picture-size', default='1600x1200', help='Size of the synthetic guest pictures (WIDTHxHEIGHT)')
+        parser.add_argument('--runs', type=int, default=3, help='Number of renders per PDF')
+        parser.add_argument('--warm', action='store_true', help='Keep the segment cache between runs')
+        parser.add_argument('--json', dest='json_path', help='Write the results as JSON to this file ("-" for stdout)')
+
+    def handle(self, *args, **options):
+        if not options['synthetic'] and not options['book_purchase_id']:
+            raise CommandError("Give a book purchase id or use --synthetic")
+        if options['runs'] < 1:
+            raise CommandError("--runs must be at least 1")
+
+        self.runs = options['runs']
+        self.warm = options['warm']
+        self.results = []
+
+        original_dirs = (settings.PDF_SEGMENT_CACHE_DIR, settings.PDF_IMAGE_CACHE_DIR)
+        os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+        # Caches isolés (sous MEDIA_ROOT, seule racine lisible par le rendu) : ni pollués ni réutilisés
+        work_dir = self.work_dir = tempfile.mkdtemp(prefix='pdf_benchmark_', dir=settings.MEDIA_ROOT)
+        settings.PDF_SEGMENT_CACHE_DIR = os.path.join(work_dir, 'segments')
+        settings.PDF_IMAGE_CACHE_DIR = os.path.join(work_dir, 'images')
+        try:
+            self.warm_up_pool()
+            if options['synthetic']:
+                guest_counts = [int(count) for count in options['guests'].split(',') if count.strip()]
+                picture_size = tuple(int(value) for value in options['picture_size'].lower().split('x'))
+                self.benchmark_synthetic(work_dir, guest_counts, picture_size)
+            else:
+                self.benchmark_book_purchase(options['book_purchase_id'])
+        finally:
+            settings.PDF_SEGMENT_CACHE_DIR, settings.PDF_IMAGE_CACHE_DIR = original_dirs
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        if options['json_path']:
+            report = {
+                'created_at': timezone.now().isoformat(),
+                'cpu_count': os.cpu_count(),
+                'render_pool_size': settings.PDF_RENDER_POOL_SIZE,
+                'template_version': settings.PDF_TEMPLATE_VERSION,
+                'runs': self.runs,
+                'warm': self.warm,
+                'results': self.results,
+            }
+            if options['json_path'] == '-':
+                json.dump(report, sys.stdout, indent=2)
+                sys.stdout.write('\n')
+            else:
+                with open(options['json_path'], 'w') as f:
+                    json.dump(report, f, indent=2)
+                self.stdout.write(f"Results written to {options['json_path']}")
+
+    def warm_up_pool(self):
+        # Démarrer tous les processus du pool avant de mesurer
+        pending = [submit_pdf_render('<p></p>', 'thank_you_note') for _ in range(max(settings.PDF_RENDER_POOL_SIZE, 1))]
+        for future in pending:
+            future.result()
+
+    def benchmark_book_purchase(self, book_purchase_id):
+        try:
+            book_purchase = BookPurchase.objects.select_related('book', 'user').get(pk=book_purchase_id)
+        except (BookPurchase.DoesNotExist, ValueError):
+            raise CommandError(f"Book purchase {book_purchase_id} not found")
+
+        # Octets que l'ancien chemin copiait dans un dossier temporaire à chaque rendu
+        copied_assets = [
+            book_purchase.custom_cover.path if book_purchase.custom_cover else book_purchase.book.cover.path,
+            book_purchase.deceased_image.path if book_purchase.deceased_image else None,
+            os.path.join(settings.BASE_DIR, 'static', 'images', 'logo.png'),
+        ]
+        copied_bytes = sum(os.path.getsize(path) for path in copied_assets if path and os.path.exists(path))
+        self.stderr.write(f"Assets copied per render by the temp-directory path: {copied_bytes / 1024:.1f} KiB")
+
+        case = {'book_purchase': str(book_purchase.id), 'guests': book_purchase.guest_infos.count()}
+        self.benchmark(case, 'visitation_book', generate_pdf, book_purchase)
+        self.benchmark(case, 'visitation_book_to_file', self.generate_pdf_file, book_purchase)
+        self.benchmark(case, 'visitation_book_web', self.generate_web_pdf, book_purchase)
+        if book_purchase.attending_note:
+            self.benchmark(case, 'thank_you_note', generate_thank_you_note_pdf, book_purchase, book_purchase.guest_infos.first())
+
+    def benchmark_synthetic(self, work_dir, guest_counts, picture_size):
+        media_dir = os.path.relpath(work_dir, settings.MEDIA_ROOT)
+        cover = self.create_image(work_dir, 'cover.jpg', (2550, 3300))
+        portrait = self.create_image(work_dir, 'portrait.jpg', (3000, 4000))
+        picture = self.create_image(work_dir, 'picture.jpg', picture_size)
+
+        with transaction.atomic():
+            user = User.objects.bulk_create([User(email=f'benchmark-{uuid.uuid4().hex}@example.com', full_name='Benchmark Family')])[0]
+            book = Book.objects.create(title='Benchmark', price=0, cover=f'{media_dir}/{cover}')
+
+            for guest_count in guest_counts:
+                # Sans visiteur, les variantes photos / notes donnent le même livre
+                variants = [(False, False)] if guest_count == 0 else [(False, False), (True, False), (False, True), (True, True)]
+                for with_pictures, with_notes in variants:
+                    book_purchase = BookPurchase(
+                        user=user,
+                        book=book,
+                        deceased_name='Jane Doe',
+                        date_of_birth=datetime.date(1940, 5, 17),
+                        date_of_death=datetime.date(2024, 3, 2),
+                        deceased_image=f'{media_dir}/{portrait}',
+                        allow_picture=with_pictures,
+                        allow_special_notes=with_notes,
+                        attending_note='<p>Dear [guest_name],</p><p>Thank you for being with us to honor [deceased_name].</p><p>[your_name]</p>',
+                    )
+                    book_purchase.save(generate_pdf=False, generate_attending_note_pdf=False)
+
+                    guests = []
+                    for i in range(guest_count):
+                        guest = GuestInfo(
+                            book_purchase=book_purchase,
+                            guest_name=f'Guest {i + 1}',
+                            guest_address=f'{i + 1} Main Street, Springfield',
+                            guest_email=f'guest{i + 1}@example.com',
+                            special_notes='We will always remember her kindness and her laugh. ' * 3 if with_notes else None,
+                        )
+                        if with_pictures:
+                            # Un fichier par visiteur, comme des uploads réels (un dérivé chacun)
+                            guest_picture = f'guest_{book_purchase.id}_{i}.jpg'
+                            shutil.copyfile(os.path.join(work_dir, picture), os.path.join(work_dir, guest_picture))
+                            guest.guest_picture = f'{media_dir}/{guest_picture}'
+                        guests.append(guest)
+                    GuestInfo.objects.bulk_create(guests)
+
+                    case = {'guests': guest_count, 'pictures': with_pictures, 'notes': with_notes}
+                    self.benchmark(case, 'visitation_book', generate_pdf, book_purchase)
+                    self.benchmark(case, 'visitation_book_to_file', self.generate_pdf_file, book_purchase)
+                    self.benchmark(case, 'visitation_book_web', self.generate_web_pdf, book_purchase)
+                    self.benchmark(case, 'thank_you_note', generate_thank_you_note_pdf, book_purchase, guests[0] if guests else None)
+
+            # Ne rien laisser en base
+            transaction.set_rollback(True)
+
+    def generate_pdf_file(self, book_purchase):
+        # Chemin de update_pdf() : le PDF est écrit dans un fichier, sans copie en mémoire
+        path = os.path.join(self.work_dir, 'output.pdf')
+        generate_pdf(book_purchase, path)
+        return path
+
+    def generate_web_pdf(self, book_purchase):
+        # Profil web : images sous-échantillonnées et mise en page simplifiée
+        return generate_pdf(book_purchase, profile='web')
+
+    def create_image(self, directory, name, size):
+        # Dégradé bruité : se compresse et se décode comme une photo
+        image = Image.merge('RGB', [
+            Image.linear_gradient('L').resize(size),
+            Image.effect_noise(size, 40),
+            Image.linear_gradient('L').rotate(90).resize(size),
+        ])
+        image.save(os.path.join(directory, name), 'JPEG', quality=90)
+        return name
+
+    def benchmark(self, case, renderer_name, renderer, *args):
+        timings = []
+        read_bytes = []
+        written_bytes = []
+        sampler = PeakRssSampler()
+        sampler.start()
+        try:
+            for _ in range(self.runs):
+                if not self.warm:
+                    shutil.rmtree(settings.PDF_SEGMENT_CACHE_DIR, ignore_errors=True)
+
+                read_before, written_before = io_counters()
+                start = time.perf_counter()
+                pdf = renderer(*args)
+                timings.append(time.perf_counter() - start)
+                read_after, written_after = io_counters()
+
+                read_bytes.append(read_after - read_before)
+                written_bytes.append(written_after - written_before)
+        finally:
+            peak_rss = sampler.stop()
+
+        result = {
+            **case,
+            'renderer': renderer_name,
+            'wall_avg': sum(timings) / self.runs,
+            'wall_min': min(timings),
+            'wall_max': max(timings),
+            'peak_rss': peak_rss,
+            'peak_rss_delta': peak_rss - sampler.baseline,
+            'size': len(pdf) if isinstance(pdf, bytes) else os.path.getsize(pdf),
+            'read_bytes': sum(read_bytes) // self.runs,
+            'written_bytes': sum(written_bytes) // self.runs,
+        }
+        self.results.append(result)
+
+        label = ', '.join(f'{key}={value}' for key, value in case.items())
+        self.stderr.write(self.style.SUCCESS(
+            f"{renderer_name} [{label}]: {result['size'] / 1024:.1f} KiB, "
+            f"avg {result['wall_avg']:.3f}s (min {result['wall_min']:.3f}s, max {result['wall_max']:.3f}s), "
+            f"peak RSS {peak_rss / 1024 ** 2:.0f} MiB (+{result['peak_rss_delta'] / 1024 ** 2:.1f} MiB), "
+            f"read {result['read_bytes'] / 1024:.1f} KiB, written {result['written_bytes'] / 1024:.1f} KiB per run"
+        ))
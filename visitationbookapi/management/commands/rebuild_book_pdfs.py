@@ -0,0 +1,135 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from visitationbook import settings
+from visitationbookapi.models import BookPurchase
+from visitationbookapi.utils import PDF_PROFILES, update_pdf, pdf_render_lock
+from concurrent import futures
+import time
+import uuid
+import datetime
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the PDFs of existing books (after a template, stylesheet or logo change)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', choices=sorted(PDF_PROFILES), action='append', help='Profile to rebuild (repeatable, default: all)')
+        parser.add_argument('--since', type=datetime.date.fromisoformat, help='Only books purchased on or after this date (YYYY-MM-DD)')
+        parser.add_argument('--until', type=datetime.date.fromisoformat, help='Only books purchased on or before this date (YYYY-MM-DD)')
+        parser.add_argument('--user', help='Only books of this user (email or id)')
+        parser.add_argument('--missing', action='store_true', help='Also render books that have no PDF yet')
+        parser.add_argument('--concurrency', type=int, default=max(settings.PDF_WORKER_POOL_SIZE, 1), help='Number of books rendered at the same time')
+        parser.add_argument('--dry-run', action='store_true', help='List the number of selected books and exit')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError("--concurrency must be at least 1")
+        # Un processus de rendu par livre en cours : le pool de la commande n'a pas la taille de celui d'un processus web
+        settings.PDF_RENDER_POOL_SIZE = options['concurrency']
+
+        book_purchases = BookPurchase.objects.filter(is_complete=True).select_related('book', 'user')
+        if options['since']:
+            book_purchases = book_purchases.filter(purchase_date__date__gte=options['since'])
+        if options['until']:
+            book_purchases = book_purchases.filter(purchase_date__date__lte=options['until'])
+        if options['user']:
+            try:
+                book_purchases = book_purchases.filter(user_id=uuid.UUID(options['user']))
+            except ValueError:
+                book_purchases = book_purchases.filter(user__email__iexact=options['user'])
+
+        profiles = options['profile'] or sorted(PDF_PROFILES)
+        if not options['missing']:
+            # Un livre sans PDF sera rendu à sa première lecture ; seuls les PDF existants sont périmés
+            has_pdf = Q()
+            for profile in profiles:
+                has_pdf |= ~Q(**{PDF_PROFILES[profile]['file_field']: ''}) & Q(**{f"{PDF_PROFILES[profile]['file_field']}__isnull": False})
+            book_purchases = book_purchases.filter(has_pdf)
+
+        # Ordre stable : une reprise après interruption parcourt les livres dans le même ordre
+        book_purchases = book_purchases.order_by('purchase_date', 'id')
+        total = book_purchases.count()
+        self.stdout.write(f"{total} books selected, profiles: {', '.join(profiles)}")
+        if options['dry_run'] or not total:
+            return
+
+        self.counts = {'rendered': 0, 'skipped': 0, 'failed': 0}
+        self.done = 0
+        self.total = total
+        self.start = time.monotonic()
+        self.last_report = 0
+
+        running = set()
+        executor = futures.ThreadPoolExecutor(max_workers=options['concurrency'])
+        try:
+            # Les rendus se font dans le pool de processus ; les threads ne font qu'attendre.
+            # Ne garder que quelques livres en vol : la file ne charge pas toute la sélection
+            for book_purchase in book_purchases.iterator(chunk_size=100):
+                if len(running) >= options['concurrency'] * 2:
+                    done, running = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                    self.collect(done)
+                running.add(executor.submit(self.rebuild, book_purchase, profiles, options['missing']))
+            done, running = futures.wait(running)
+            self.collect(done)
+        except KeyboardInterrupt:
+            self.stdout.write("Interrupted, waiting for the books being rendered...")
+            for future in running:
+                future.cancel()
+            self.collect(future for future in running if not future.cancelled())
+            self.report(force=True)
+            self.stdout.write(self.style.WARNING("Run the same command again to resume: books already rebuilt are skipped"))
+            return
+        finally:
+            executor.shutdown(wait=True)
+
+        self.report(force=True)
+        self.stdout.write(self.style.SUCCESS(f"Rebuild finished in {time.monotonic() - self.start:.1f}s"))
+
+    def rebuild(self, book_purchase, profiles, missing):
+        """Reconstruit les PDF d'un livre ; renvoie (livre, {profil: 'rendered' | 'skipped' | erreur})"""
+        results = {}
+        try:
+            for profile in profiles:
+                if not missing and not getattr(book_purchase, PDF_PROFILES[profile]['file_field']):
+                    continue
+                try:
+                    # Même verrou que les rendus à la demande et le worker : jamais deux rendus d'un livre
+                    with pdf_render_lock(book_purchase):
+                        # Un livre dont le rendu ne changerait pas (même empreinte) n'est pas re-rendu
+                        results[profile] = 'rendered' if update_pdf(book_purchase, profile) else 'skipped'
+                except Exception as e:
+                    results[profile] = e
+            return book_purchase, results
+        finally:
+            # Chaque thread a sa propre connexion à la base
+            connection.close()
+
+    def collect(self, done):
+        for future in done:
+            book_purchase, results = future.result()
+            errors = {profile: result for profile, result in results.items() if isinstance(result, Exception)}
+            if errors:
+                self.counts['failed'] += 1
+                for profile, error in errors.items():
+                    self.stderr.write(self.style.ERROR(f"Failed to render {profile} PDF for book_purchase {book_purchase.id}: {error}"))
+            elif 'rendered' in results.values():
+                self.counts['rendered'] += 1
+            else:
+                self.counts['skipped'] += 1
+            self.done += 1
+            self.report()
+
+    def report(self, force=False):
+        # Une ligne de progression toutes les 5 secondes au plus
+        now = time.monotonic()
+        if not force and now - self.last_report < 5:
+            return
+        self.last_report = now
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed else 0
+        eta = (self.total - self.done) / rate if rate else 0
+        self.stdout.write(
+            f"[{self.done}/{self.total}] {self.counts['rendered']} rendered, {self.counts['skipped']} unchanged, "
+            f"{self.counts['failed']} failed - {rate:.2f} books/s, ETA {eta:.0f}s"
+        )
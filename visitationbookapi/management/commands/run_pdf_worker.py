@@ -0,0 +1,82 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from visitationbook import settings
+from visitationbookapi.models import BookPurchase, GuestInfo, PdfRenderJob
+from visitationbookapi.utils import send_thank_you_notes
+from concurrent import futures
+import time
+
+
+class Command(BaseCommand):
+    help = 'Process queued PDF render jobs and thank-you notes outside of the request cycle'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Process the queued jobs then exit')
+        parser.add_argument('--sleep', type=float, default=settings.PDF_RENDER_POLL_INTERVAL, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--concurrency', type=int, default=max(settings.PDF_WORKER_POOL_SIZE, 1), help='Number of jobs processed at the same time')
+
+    def handle(self, *args, **options):
+        # Un processus de rendu par job en cours : le pool du worker n'a pas la taille de celui d'un processus web
+        settings.PDF_RENDER_POOL_SIZE = options['concurrency']
+        self.stdout.write(f"PDF worker started ({options['concurrency']} concurrent jobs)")
+        running = set()
+        # Les rendus eux-mêmes se font dans le pool de processus ; les threads ne font qu'attendre
+        executor = futures.ThreadPoolExecutor(max_workers=options['concurrency'])
+        try:
+            while True:
+                # Éviter de garder une connexion expirée entre deux scrutations
+                close_old_connections()
+                if len(running) < options['concurrency']:
+                    job = PdfRenderJob.claim_next()
+                    if job is not None:
+                        running.add(executor.submit(self.run_job, job))
+                        continue
+                    # Notes de remerciement à envoyer, par lots de guests d'un même livre
+                    guests = GuestInfo.claim_thank_you_notes(settings.THANK_YOU_BATCH_SIZE)
+                    if guests:
+                        running.add(executor.submit(self.run_thank_you_notes, guests))
+                        continue
+
+                if not running:
+                    if options['once']:
+                        break
+                    time.sleep(options['sleep'])
+                    continue
+
+                done, running = futures.wait(running, timeout=options['sleep'], return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    success, message = future.result()
+                    self.stdout.write(self.style.SUCCESS(message) if success else self.style.ERROR(message))
+        except KeyboardInterrupt:
+            self.stdout.write("PDF worker stopped")
+        finally:
+            executor.shutdown(wait=True)
+
+    def run_job(self, job):
+        try:
+            if job.run():
+                return True, (
+                    f"Rendered PDF for book_purchase {job.book_purchase_id} in {job.duration:.2f}s "
+                    f"({job.coalesced_requests} coalesced requests)"
+                )
+            return False, f"Failed to render PDF for book_purchase {job.book_purchase_id}: {job.error}"
+        finally:
+            # Chaque thread a sa propre connexion à la base
+            connection.close()
+
+    def run_thank_you_notes(self, guests):
+        start = time.monotonic()
+        book_purchase_id = guests[0].book_purchase_id
+        try:
+            book_purchase = BookPurchase.objects.select_related('user', 'book').get(pk=book_purchase_id)
+            queued = send_thank_you_notes(book_purchase, guests)
+            return queued == len(guests), (
+                f"Queued {queued}/{len(guests)} thank-you notes for book_purchase {book_purchase_id} "
+                f"in {time.monotonic() - start:.2f}s"
+            )
+        except Exception as e:
+            # Les guests non traités ne restent pas en `rendering` jusqu'à leur reprise
+            GuestInfo.objects.filter(pk__in=[guest.pk for guest in guests], thank_you_status='rendering').update(thank_you_status='failed', thank_you_error=str(e))
+            return False, f"Failed to send thank-you notes for book_purchase {book_purchase_id}: {e}"
+        finally:
+            connection.close()
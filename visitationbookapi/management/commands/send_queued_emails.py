@@ -0,0 +1,65 @@
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from visitationbook import settings
+from visitationbookapi.models import OutboxEmail
+import smtplib
+import time
+
+
+class Command(BaseCommand):
+    help = 'Deliver the queued emails of the outbox over a reused SMTP connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Deliver the queued emails then exit')
+        parser.add_argument('--sleep', type=float, default=settings.EMAIL_OUTBOX_POLL_INTERVAL, help='Seconds to wait when the outbox is empty')
+        parser.add_argument('--batch-size', type=int, default=settings.EMAIL_OUTBOX_BATCH_SIZE, help='Number of emails sent over one connection')
+
+    def handle(self, *args, **options):
+        self.stdout.write("Email worker started")
+        try:
+            while True:
+                # Éviter de garder une connexion expirée entre deux scrutations
+                close_old_connections()
+                emails = OutboxEmail.claim_batch(options['batch_size'])
+                if emails:
+                    self.deliver(emails)
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+        except KeyboardInterrupt:
+            self.stdout.write("Email worker stopped")
+
+    def deliver(self, emails):
+        # Une seule connexion SMTP pour tout le lot
+        connection = get_connection()
+        sent = 0
+        start = time.monotonic()
+        try:
+            for email in emails:
+                # Un message qui ne se construit pas (pièce jointe manquante...) n'affecte pas la connexion
+                try:
+                    message = email.build_message(connection)
+                except Exception as e:
+                    self.fail(email, e)
+                    continue
+                try:
+                    connection.open()
+                    connection.send_messages([message])
+                except (smtplib.SMTPException, OSError) as e:
+                    self.fail(email, e)
+                    # La connexion est peut-être rompue : en rouvrir une pour le message suivant
+                    connection.close()
+                except Exception as e:
+                    self.fail(email, e)
+                else:
+                    email.mark_sent()
+                    sent += 1
+        finally:
+            connection.close()
+        self.stdout.write(self.style.SUCCESS(f"Sent {sent}/{len(emails)} emails in {time.monotonic() - start:.2f}s"))
+
+    def fail(self, email, error):
+        email.mark_failed(error)
+        self.stdout.write(self.style.ERROR(f"Failed to send email {email.id} to {', '.join(email.to)} (attempt {email.attempts}): {error}"))
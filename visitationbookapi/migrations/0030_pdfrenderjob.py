@@ -0,0 +1,38 @@
+# Generated by Django 5.0.7 on 2026-10-18 11:34
+
+import django.db.models.deletion
+import uuid
+import visitationbook.os.fields
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitationbookapi', '0029_guestinfo_thank_you_pdf'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PdfRenderJob',
+            fields=[
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Registration date')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Modification date')),
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='queued', max_length=20, verbose_name='Status')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Started At')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Finished At')),
+                ('duration', models.FloatField(blank=True, help_text='Render duration in seconds', null=True, verbose_name='Duration')),
+                ('error', models.TextField(blank=True, null=True, verbose_name='Error')),
+                ('book_purchase', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pdf_render_jobs', to='visitationbookapi.bookpurchase', verbose_name='Book Purchase')),
+                ('created_by', visitationbook.os.fields.UserForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='created_%(app_label)s_%(class)s_set', to=settings.AUTH_USER_MODEL, verbose_name='Added by')),
+                ('updated_by', visitationbook.os.fields.UserForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='modified_%(app_label)s_%(class)s_set', to=settings.AUTH_USER_MODEL, verbose_name='Modified by')),
+            ],
+            options={
+                'verbose_name': 'PDF Render Job',
+                'verbose_name_plural': 'PDF Render Jobs',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
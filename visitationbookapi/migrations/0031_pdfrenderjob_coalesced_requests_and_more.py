@@ -0,0 +1,23 @@
+# Generated by Django 5.0.7 on 2026-10-18 11:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitationbookapi', '0030_pdfrenderjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pdfrenderjob',
+            name='coalesced_requests',
+            field=models.PositiveIntegerField(default=0, help_text='Render requests merged into this job (renders saved)', verbose_name='Coalesced Requests'),
+        ),
+        migrations.AddField(
+            model_name='pdfrenderjob',
+            name='run_after',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='End of the coalescing window', null=True, verbose_name='Run After'),
+        ),
+    ]
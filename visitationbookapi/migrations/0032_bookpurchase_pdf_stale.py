@@ -0,0 +1,25 @@
+# Generated by Django 5.0.7 on 2026-10-18 11:40
+
+from django.db import migrations, models
+
+
+def mark_existing_pdfs_fresh(apps, schema_editor):
+    # Les livres déjà rendus gardent leur PDF actuel
+    BookPurchase = apps.get_model('visitationbookapi', 'BookPurchase')
+    BookPurchase.objects.exclude(pdf_file__isnull=True).exclude(pdf_file='').update(pdf_stale=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitationbookapi', '0031_pdfrenderjob_coalesced_requests_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookpurchase',
+            name='pdf_stale',
+            field=models.BooleanField(default=True, help_text='Set by writes, cleared when the PDF is rendered', verbose_name='PDF is stale'),
+        ),
+        migrations.RunPython(mark_existing_pdfs_fresh, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 11:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitationbookapi', '0032_bookpurchase_pdf_stale'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookpurchase',
+            name='pdf_fingerprint',
+            field=models.CharField(blank=True, help_text='Fingerprint of the render inputs of pdf_file', max_length=64, null=True, verbose_name='PDF Fingerprint'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.7 on 2026-10-18 11:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitationbookapi', '0033_bookpurchase_pdf_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookpurchase',
+            name='web_pdf_file',
+            field=models.FileField(blank=True, help_text='Lightweight preview of the book, rendered on every change', null=True, upload_to='book_purchase_web_pdfs/', verbose_name='Web PDF File'),
+        ),
+        migrations.AddField(
+            model_name='bookpurchase',
+            name='web_pdf_fingerprint',
+            field=models.CharField(blank=True, help_text='Fingerprint of the render inputs of web_pdf_file', max_length=64, null=True, verbose_name='Web PDF Fingerprint'),
+        ),
+        migrations.AddField(
+            model_name='pdfrenderjob',
+            name='profile',
+            field=models.CharField(choices=[('print', 'Print'), ('web', 'Web')], default='print', max_length=10, verbose_name='Profile'),
+        ),
+    ]
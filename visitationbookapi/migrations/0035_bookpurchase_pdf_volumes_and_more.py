@@ -0,0 +1,23 @@
+# Generated by Django 5.0.7 on 2026-10-18 12:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitationbookapi', '0034_bookpurchase_web_pdf_file_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookpurchase',
+            name='pdf_volumes',
+            field=models.PositiveIntegerField(default=1, help_text='Number of volumes of pdf_file (large books are split)', verbose_name='PDF Volumes'),
+        ),
+        migrations.AddField(
+            model_name='bookpurchase',
+            name='web_pdf_volumes',
+            field=models.PositiveIntegerField(default=1, help_text='Number of volumes of web_pdf_file (large books are split)', verbose_name='Web PDF Volumes'),
+        ),
+    ]
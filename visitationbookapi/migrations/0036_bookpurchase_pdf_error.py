@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 12:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitationbookapi', '0035_bookpurchase_pdf_volumes_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookpurchase',
+            name='pdf_error',
+            field=models.TextField(blank=True, help_text='Error of the last failed PDF render (book or thank you note)', null=True, verbose_name='PDF Error'),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.0.7 on 2026-10-18 12:06
+
+import django.db.models.deletion
+import uuid
+import visitationbook.os.fields
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitationbookapi', '0036_bookpurchase_pdf_error'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEmail',
+            fields=[
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Registration date')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Modification date')),
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('kind', models.CharField(blank=True, db_index=True, help_text='Helper that queued the email (welcome, thank_you...)', max_length=50, verbose_name='Kind')),
+                ('subject', models.CharField(max_length=998, verbose_name='Subject')),
+                ('body', models.TextField(verbose_name='Plain Text Body')),
+                ('html_body', models.TextField(blank=True, null=True, verbose_name='HTML Body')),
+                ('from_email', models.CharField(blank=True, max_length=255, null=True, verbose_name='From')),
+                ('to', models.JSONField(default=list, verbose_name='To')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], db_index=True, default='queued', max_length=20, verbose_name='Status')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Attempts')),
+                ('next_attempt_at', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Next Attempt At')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Started At')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='Sent At')),
+                ('error', models.TextField(blank=True, null=True, verbose_name='Error')),
+                ('created_by', visitationbook.os.fields.UserForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='created_%(app_label)s_%(class)s_set', to=settings.AUTH_USER_MODEL, verbose_name='Added by')),
+                ('updated_by', visitationbook.os.fields.UserForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='modified_%(app_label)s_%(class)s_set', to=settings.AUTH_USER_MODEL, verbose_name='Modified by')),
+            ],
+            options={
+                'verbose_name': 'Outbox Email',
+                'verbose_name_plural': 'Outbox Emails',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='OutboxAttachment',
+            fields=[
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Registration date')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Modification date')),
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('file', models.FileField(upload_to='outbox_attachments/', verbose_name='File')),
+                ('filename', models.CharField(max_length=255, verbose_name='File Name')),
+                ('mimetype', models.CharField(default='application/octet-stream', max_length=100, verbose_name='MIME Type')),
+                ('content_id', models.CharField(blank=True, help_text='Set for images inlined in the HTML body', max_length=255, null=True, verbose_name='Content ID')),
+                ('created_by', visitationbook.os.fields.UserForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='created_%(app_label)s_%(class)s_set', to=settings.AUTH_USER_MODEL, verbose_name='Added by')),
+                ('updated_by', visitationbook.os.fields.UserForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='modified_%(app_label)s_%(class)s_set', to=settings.AUTH_USER_MODEL, verbose_name='Modified by')),
+                ('email', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='visitationbookapi.outboxemail', verbose_name='Email')),
+            ],
+            options={
+                'verbose_name': 'Outbox Attachment',
+                'verbose_name_plural': 'Outbox Attachments',
+                'ordering': ['created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.7 on 2026-10-18 12:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitationbookapi', '0037_outboxemail_outboxattachment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='guestinfo',
+            name='thank_you_email',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='thank_you_guests', to='visitationbookapi.outboxemail', verbose_name='Thank You Email'),
+        ),
+        migrations.AddField(
+            model_name='guestinfo',
+            name='thank_you_error',
+            field=models.TextField(blank=True, null=True, verbose_name='Thank You Note Error'),
+        ),
+        migrations.AddField(
+            model_name='guestinfo',
+            name='thank_you_requested_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Thank You Note Requested At'),
+        ),
+        migrations.AddField(
+            model_name='guestinfo',
+            name='thank_you_started_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Thank You Note Started At'),
+        ),
+        migrations.AddField(
+            model_name='guestinfo',
+            name='thank_you_status',
+            field=models.CharField(blank=True, choices=[('pending', 'Pending'), ('rendering', 'Rendering'), ('queued', 'Queued'), ('sent', 'Sent'), ('failed', 'Failed')], db_index=True, max_length=20, null=True, verbose_name='Thank You Note Status'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 12:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitationbookapi', '0038_guestinfo_thank_you_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookpurchase',
+            name='thank_you_delivery',
+            field=models.CharField(choices=[('attachment', 'Attachment'), ('link', 'Download link')], default='attachment', help_text='Attach the thank you PDF to guest emails, or send an expiring download link', max_length=20, verbose_name='Thank You Note Delivery'),
+        ),
+    ]
@@ -1,7 +1,9 @@
 import os
 import uuid
 import time
+import logging
 import mimetypes
+from email.mime.image import MIMEImage
 from visitationbook.os.abstract import CoreModel
 from django.db import models
 from django.contrib.auth.models import AbstractUser
@@ -10,8 +12,13 @@ from visitationbookapi.managers import UserManager
 from visitationbookapi.utils import *
 from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
+from django.core.mail import EmailMultiAlternatives
+from django.db import transaction
 from django.utils import timezone
 
+logger = logging.getLogger('visitationbookapi')
+
+
 class User(AbstractUser, CoreModel):
     def _generate_document_path(self, filename):
         # Save original file name in model
@@ -254,6 +261,11 @@ class FuneralHomeSubscription(CoreModel):
 
 
 class BookPurchase(CoreModel):
+    THANK_YOU_DELIVERY_CHOICES = [
+        ('attachment', 'Attachment'),
+        ('link', 'Download link'),
+    ]
+
     def _generate_deceased_image_path(self, filename):
         # Get new file name/upload path
         base, ext = os.path.splitext(filename)
@@ -309,6 +321,13 @@ class BookPurchase(CoreModel):
     
     # PDF File Generation
     pdf_file = models.FileField(upload_to='book_purchase_pdfs/', null=True, blank=True)
+    pdf_stale = models.BooleanField(default=True, verbose_name="PDF is stale", help_text="Set by writes, cleared when the PDF is rendered")
+    pdf_fingerprint = models.CharField(max_length=64, null=True, blank=True, verbose_name="PDF Fingerprint", help_text="Fingerprint of the render inputs of pdf_file")
+    web_pdf_file = models.FileField(upload_to='book_purchase_web_pdfs/', null=True, blank=True, verbose_name="Web PDF File", help_text="Lightweight preview of the book, rendered on every change")
+    pdf_volumes = models.PositiveIntegerField(default=1, verbose_name="PDF Volumes", help_text="Number of volumes of pdf_file (large books are split)")
+    web_pdf_volumes = models.PositiveIntegerField(default=1, verbose_name="Web PDF Volumes", help_text="Number of volumes of web_pdf_file (large books are split)")
+    web_pdf_fingerprint = models.CharField(max_length=64, null=True, blank=True, verbose_name="Web PDF Fingerprint", help_text="Fingerprint of the render inputs of web_pdf_file")
+    pdf_error = models.TextField(null=True, blank=True, verbose_name="PDF Error", help_text="Error of the last failed PDF render (book or thank you note)")
     is_complete = models.BooleanField(default=False, verbose_name="Is complete checking")
     
     # Guest Visit Count
@@ -316,6 +335,7 @@ class BookPurchase(CoreModel):
     
     attending_note = models.TextField(verbose_name="Attending Note", blank=True, null=True, help_text="HTML formatted thank you message from the book purchaser")
     attending_note_pdf = models.FileField(upload_to='book_purchase_attending_note_pdfs/', null=True, blank=True)
+    thank_you_delivery = models.CharField(max_length=20, choices=THANK_YOU_DELIVERY_CHOICES, default='attachment', verbose_name="Thank You Note Delivery", help_text="Attach the thank you PDF to guest emails, or send an expiring download link")
     
     subscription = models.ForeignKey(FuneralHomeSubscription, on_delete=models.SET_NULL, null=True, blank=True, related_name='book_purchases')
 
@@ -326,21 +346,86 @@ class BookPurchase(CoreModel):
             self.is_complete = False
 
     def generate_initial_pdf(self):
-        if not self.pdf_file and self.is_complete:
-            try:
-                # Attendre un court instant pour s'assurer que les fichiers sont bien sauvegardés
-                time.sleep(0.5)
-                update_pdf(self)
-            except Exception as e:
-                print(f"Error generating PDF for book_purchase {self.id}: {e}")
+        # Le PDF web est re-rendu à chaque modification ; le PDF d'impression n'est rendu
+        # qu'à la demande (voir can_serve_pdf), sauf en mode PDF_EAGER_RENDER
+        if not self.is_complete:
+            return
+        if settings.PDF_WEB_EAGER_RENDER:
+            self.request_pdf_render('web')
+        if settings.PDF_EAGER_RENDER:
+            self.request_pdf_render('print')
+
+    def mark_pdf_stale(self):
+        """Signale que le PDF ne reflète plus le contenu du livre"""
+        BookPurchase.objects.filter(pk=self.pk).update(pdf_stale=True)
+        self.pdf_stale = True
+        self.generate_initial_pdf()
+
+    def is_pdf_up_to_date(self, profile='print'):
+        """Vrai si le PDF du profil correspond exactement au contenu actuel du livre"""
+        config = PDF_PROFILES[profile]
+        return bool(getattr(self, config['file_field'])) and getattr(self, config['fingerprint_field']) == compute_pdf_fingerprint(self, profile)
+
+    def can_serve_pdf(self, profile='print'):
+        """
+        Vrai si le PDF du profil peut être servi sans attendre un rendu.
+        Le PDF web existant est servi pendant son rafraîchissement (placé en file à chaque
+        modification avec PDF_WEB_EAGER_RENDER). Le PDF d'impression doit être à jour :
+        ni marqué obsolète, ni en attente d'un rendu.
+        """
+        if not getattr(self, PDF_PROFILES[profile]['file_field']):
+            return False
+        if profile == 'web':
+            return True
+        if not self.pdf_stale and not self.pdf_render_jobs.filter(profile=profile, status__in=['queued', 'running']).exists():
+            return True
+
+        # Une écriture sans changement visible (paiement, abonnement...) marque aussi le PDF
+        # obsolète : l'empreinte tranche. Le drapeau est acquitté avant le calcul, comme dans
+        # update_pdf, pour qu'une écriture concurrente le remette à True
+        BookPurchase.objects.filter(pk=self.pk).update(pdf_stale=False)
+        if self.pdf_fingerprint == compute_pdf_fingerprint(self, profile):
+            self.pdf_stale = False
+            return True
+        BookPurchase.objects.filter(pk=self.pk).update(pdf_stale=True)
+        self.pdf_stale = True
+        return False
+
+    def request_pdf_render(self, profile='print', immediate=False):
+        """
+        Place le rendu du PDF du profil dans la file d'attente traitée par `run_pdf_worker`.
+        Les demandes reçues pendant PDF_RENDER_COALESCE_WINDOW sont regroupées dans
+        le job déjà en attente, qui rendra l'état le plus récent du livre.
+        immediate : demande d'un lecteur qui attend le fichier, le job part sans attendre
+        la fin de la fenêtre de regroupement.
+        """
+        with transaction.atomic():
+            # Verrouiller le livre pour sérialiser les demandes concurrentes
+            BookPurchase.objects.select_for_update().filter(pk=self.pk).exists()
+            job = self.pdf_render_jobs.select_for_update().filter(status='queued', profile=profile).first()
+            now = timezone.now()
+            if job:
+                PdfRenderJob.objects.filter(pk=job.pk).update(coalesced_requests=models.F('coalesced_requests') + 1)
+                if immediate and job.run_after and job.run_after > now:
+                    PdfRenderJob.objects.filter(pk=job.pk).update(run_after=now)
+                    job.run_after = now
+                return job
+
+            run_after = now if immediate else now + timezone.timedelta(seconds=settings.PDF_RENDER_COALESCE_WINDOW)
+            return PdfRenderJob.objects.create(book_purchase=self, profile=profile, run_after=run_after)
             
-    def delete_existing_pdf(self):
-        if self.pdf_file:
-            if os.path.isfile(self.pdf_file.path):
-                os.remove(self.pdf_file.path)
-            self.pdf_file = None
-            self.save()
-    
+    def request_thank_you_notes(self):
+        """
+        Programme l'envoi de la note de remerciement personnalisée à tous les visiteurs ayant
+        un email, traité par `run_pdf_worker`. Renvoie le nombre de visiteurs concernés.
+        """
+        return (
+            self.guest_infos.exclude(guest_email__isnull=True).exclude(guest_email='')
+            # Déjà en cours d'envoi (y compris un email en attente dans l'outbox) : pas de doublon
+            .exclude(thank_you_status__in=['pending', 'rendering', 'queued'])
+            .update(thank_you_status='pending', thank_you_requested_at=timezone.now(), thank_you_started_at=None, thank_you_error=None)
+        )
+
     def delete_existing_attending_note_pdf(self):
         """Supprime le fichier PDF existant s'il existe"""
         if self.attending_note_pdf:
@@ -376,7 +461,7 @@ class BookPurchase(CoreModel):
             return True
             
         except Exception as e:
-            print(f"Error generating attending note PDF template for book_purchase {self.id}: {e}")
+            logger.error("Error generating attending note PDF template for book_purchase %s: %s", self.id, e)
             return False
             
     def increment_visit_count(self):
@@ -403,12 +488,16 @@ class BookPurchase(CoreModel):
 
         # Vérifier si l'état est complet
         self.check_completion()
+
+        # Une modification complète du livre rend le PDF obsolète (pas les mises à jour ciblées)
+        if generate_pdf and not is_new and not kwargs.get('update_fields'):
+            self.pdf_stale = True
         
         # Sauvegarder l'instance
         super().save(*args, **kwargs)
 
-        # Générer le PDF principal si nécessaire
-        if generate_pdf and self.is_complete and not is_new:
+        # Demander le rendu du PDF principal si nécessaire
+        if generate_pdf and self.is_complete and not is_new and self.pdf_stale:
             self.generate_initial_pdf()
 
         # Générer le PDF de la note de remerciement si nécessaire
@@ -439,6 +528,14 @@ class GuestInfo(CoreModel):
         newname = "%s%s" % (uuid.uuid4(), ext)
         return os.path.join('{}'.format("thank_you_pdfs"), newname)
 
+    THANK_YOU_STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('rendering', 'Rendering'),
+        ('queued', 'Queued'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     book_purchase = models.ForeignKey(BookPurchase, on_delete=models.CASCADE, related_name='guest_infos', verbose_name="Book Purchase")
     guest_picture = models.ImageField(upload_to=_generate_guest_picture_path, verbose_name="Guest Picture", blank=True, null=True, help_text="Guest's Picture if required")
@@ -447,6 +544,51 @@ class GuestInfo(CoreModel):
     guest_email = models.EmailField(verbose_name="Guest Email", blank=True, null=True)
     special_notes = models.TextField(verbose_name="Special Notes to the Family", blank=True, null=True)
     thank_you_pdf = models.FileField(upload_to=_generate_thank_you_pdfs_path, verbose_name="Guest Thank You PDF", blank=True, null=True)
+    thank_you_status = models.CharField(max_length=20, choices=THANK_YOU_STATUS_CHOICES, null=True, blank=True, db_index=True, verbose_name="Thank You Note Status")
+    thank_you_requested_at = models.DateTimeField(null=True, blank=True, verbose_name="Thank You Note Requested At")
+    thank_you_started_at = models.DateTimeField(null=True, blank=True, verbose_name="Thank You Note Started At")
+    thank_you_email = models.ForeignKey('OutboxEmail', on_delete=models.SET_NULL, null=True, blank=True, related_name='thank_you_guests', verbose_name="Thank You Email")
+    thank_you_error = models.TextField(null=True, blank=True, verbose_name="Thank You Note Error")
+
+    @classmethod
+    def claim_thank_you_notes(cls, size):
+        """
+        Réserve jusqu'à size guests d'un même livre dont la note de remerciement est à envoyer.
+        Les rendus restés en `rendering` au-delà de THANK_YOU_RENDER_TIMEOUT (worker arrêté
+        en plein rendu) sont repris.
+        """
+        now = timezone.now()
+        expired = now - timezone.timedelta(seconds=settings.THANK_YOU_RENDER_TIMEOUT)
+        claimable = models.Q(thank_you_status='pending') | models.Q(thank_you_status='rendering', thank_you_started_at__lt=expired)
+        with transaction.atomic():
+            first = cls.objects.select_for_update(skip_locked=True).filter(claimable).order_by('thank_you_requested_at').first()
+            if first is None:
+                return []
+            # Un lot par livre : le fond commun de la note n'est rendu qu'une fois
+            guests = list(
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(claimable, book_purchase_id=first.book_purchase_id)
+                .order_by('thank_you_requested_at', 'created_at')[:size]
+            )
+            cls.objects.filter(pk__in=[guest.pk for guest in guests]).update(thank_you_status='rendering', thank_you_started_at=now)
+        for guest in guests:
+            guest.thank_you_status = 'rendering'
+            guest.thank_you_started_at = now
+        return guests
+
+    def request_thank_you_note(self):
+        """Programme l'envoi de la note de remerciement personnalisée du guest, traité par `run_pdf_worker`"""
+        self.thank_you_status = 'pending'
+        self.thank_you_requested_at = timezone.now()
+        self.thank_you_started_at = None
+        self.thank_you_error = None
+        # Mise à jour ciblée : un save() marquerait le PDF du livre obsolète
+        GuestInfo.objects.filter(pk=self.pk).update(
+            thank_you_status=self.thank_you_status,
+            thank_you_requested_at=self.thank_you_requested_at,
+            thank_you_started_at=None,
+            thank_you_error=None,
+        )
 
     def __str__(self):
         return self.guest_name if self.guest_name else "Guest Info"
@@ -485,5 +627,199 @@ class Obituary(CoreModel):
         verbose_name_plural = "Obituaries"
         verbose_name = "Obituary"
         ordering = ['-created_at']
-        
-        
+
+
+class PdfRenderJob(CoreModel):
+    """File d'attente persistante des rendus PDF, traitée hors requête par `manage.py run_pdf_worker`"""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    PROFILE_CHOICES = [
+        ('print', 'Print'),
+        ('web', 'Web'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    book_purchase = models.ForeignKey(BookPurchase, on_delete=models.CASCADE, related_name='pdf_render_jobs', verbose_name="Book Purchase")
+    profile = models.CharField(max_length=10, choices=PROFILE_CHOICES, default='print', verbose_name="Profile")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued', db_index=True, verbose_name="Status")
+    run_after = models.DateTimeField(null=True, blank=True, db_index=True, verbose_name="Run After", help_text="End of the coalescing window")
+    coalesced_requests = models.PositiveIntegerField(default=0, verbose_name="Coalesced Requests", help_text="Render requests merged into this job (renders saved)")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="Started At")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="Finished At")
+    duration = models.FloatField(null=True, blank=True, verbose_name="Duration", help_text="Render duration in seconds")
+    error = models.TextField(null=True, blank=True, verbose_name="Error")
+
+    @classmethod
+    def claim_next(cls):
+        """
+        Réserve le prochain job à traiter dont la fenêtre de regroupement est écoulée.
+        Les jobs restés en `running` au-delà de PDF_RENDER_JOB_TIMEOUT (worker arrêté
+        en plein rendu) sont repris.
+        """
+        now = timezone.now()
+        expired = now - timezone.timedelta(seconds=settings.PDF_RENDER_JOB_TIMEOUT)
+        ready = models.Q(run_after__isnull=True) | models.Q(run_after__lte=now)
+        with transaction.atomic():
+            job = (
+                cls.objects.select_for_update(skip_locked=True)
+                .filter((models.Q(status='queued') & ready) | models.Q(status='running', started_at__lt=expired))
+                .order_by('created_at')
+                .first()
+            )
+            if job is None:
+                return None
+            job.status = 'running'
+            job.started_at = now
+            job.save(update_fields=['status', 'started_at'])
+        return job
+
+    def run(self):
+        """Génère le PDF du book purchase et enregistre le résultat du job"""
+        start = time.monotonic()
+        try:
+            with pdf_render_lock(self.book_purchase):
+                update_pdf(self.book_purchase, self.profile)
+            self.status = 'done'
+            self.error = None
+        except Exception as e:
+            self.status = 'failed'
+            self.error = str(e)
+            logger.error("Error generating %s PDF for book_purchase %s: %s", self.profile, self.book_purchase_id, e)
+        self.duration = time.monotonic() - start
+        self.finished_at = timezone.now()
+        self.save(update_fields=['status', 'error', 'duration', 'finished_at'])
+        return self.status == 'done'
+
+    def __str__(self):
+        return f"{self.book_purchase_id} - {self.get_profile_display()} - {self.get_status_display()}"
+
+    class Meta:
+        verbose_name_plural = "PDF Render Jobs"
+        verbose_name = "PDF Render Job"
+        ordering = ['-created_at']
+
+
+class OutboxEmail(CoreModel):
+    """
+    Email en attente d'envoi : les helpers d'envoi l'enregistrent ici au lieu de parler au
+    serveur SMTP pendant la requête ; `manage.py send_queued_emails` les délivre par lots.
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=50, blank=True, db_index=True, verbose_name="Kind", help_text="Helper that queued the email (welcome, thank_you...)")
+    subject = models.CharField(max_length=998, verbose_name="Subject")
+    body = models.TextField(verbose_name="Plain Text Body")
+    html_body = models.TextField(null=True, blank=True, verbose_name="HTML Body")
+    from_email = models.CharField(max_length=255, null=True, blank=True, verbose_name="From")
+    to = models.JSONField(default=list, verbose_name="To")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued', db_index=True, verbose_name="Status")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="Attempts")
+    next_attempt_at = models.DateTimeField(null=True, blank=True, db_index=True, verbose_name="Next Attempt At")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="Started At")
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name="Sent At")
+    error = models.TextField(null=True, blank=True, verbose_name="Error")
+
+    @classmethod
+    def claim_batch(cls, size):
+        """
+        Réserve jusqu'à size emails à envoyer. Les emails restés en `sending` au-delà de
+        EMAIL_OUTBOX_SENDING_TIMEOUT (worker arrêté en plein envoi) sont repris.
+        """
+        now = timezone.now()
+        expired = now - timezone.timedelta(seconds=settings.EMAIL_OUTBOX_SENDING_TIMEOUT)
+        ready = models.Q(next_attempt_at__isnull=True) | models.Q(next_attempt_at__lte=now)
+        with transaction.atomic():
+            emails = list(
+                cls.objects.select_for_update(skip_locked=True)
+                .filter((models.Q(status='queued') & ready) | models.Q(status='sending', started_at__lt=expired))
+                .order_by('created_at')[:size]
+            )
+            cls.objects.filter(pk__in=[email.pk for email in emails]).update(status='sending', started_at=now)
+        for email in emails:
+            email.status = 'sending'
+            email.started_at = now
+        return emails
+
+    def build_message(self, connection=None):
+        """Message Django prêt à envoyer, avec ses pièces jointes"""
+        msg = EmailMultiAlternatives(self.subject, self.body, self.from_email or settings.DEFAULT_FROM_EMAIL, self.to, connection=connection)
+        if self.html_body:
+            msg.attach_alternative(self.html_body, "text/html")
+        for attachment in self.attachments.all():
+            with attachment.file.open('rb') as f:
+                content = f.read()
+            if attachment.content_id:
+                # Image intégrée au corps HTML (cid:)
+                msg_img = MIMEImage(content, _subtype=attachment.mimetype.split('/')[1])
+                msg_img.add_header('Content-ID', f'<{attachment.content_id}>')
+                msg_img.add_header('Content-Disposition', 'inline', filename=attachment.filename)
+                msg.attach(msg_img)
+            else:
+                msg.attach(attachment.filename, content, attachment.mimetype)
+        return msg
+
+    def mark_sent(self):
+        self.status = 'sent'
+        self.attempts += 1
+        self.sent_at = timezone.now()
+        self.error = None
+        self.save(update_fields=['status', 'attempts', 'sent_at', 'error'])
+        self.thank_you_guests.filter(thank_you_status='queued').update(thank_you_status='sent')
+
+        # Les copies des pièces jointes ne servent plus ; les fichiers joints sans copie
+        # (PDF d'un guest...) appartiennent à leur modèle et sont conservés
+        upload_to = OutboxAttachment._meta.get_field('file').upload_to
+        for attachment in self.attachments.all():
+            if attachment.file.name.startswith(upload_to):
+                attachment.file.delete(save=False)
+        self.attachments.all().delete()
+
+    def mark_failed(self, error):
+        """Replanifie l'envoi avec un délai exponentiel, ou l'abandonne après EMAIL_OUTBOX_MAX_ATTEMPTS essais"""
+        self.attempts += 1
+        self.error = str(error)
+        if self.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+            self.status = 'failed'
+            logger.error("Giving up on email %s to %s after %s attempts: %s", self.id, self.to, self.attempts, error)
+            self.thank_you_guests.filter(thank_you_status='queued').update(thank_you_status='failed', thank_you_error=self.error)
+        else:
+            self.status = 'queued'
+            delay = settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (self.attempts - 1)
+            self.next_attempt_at = timezone.now() + timezone.timedelta(seconds=delay)
+        self.save(update_fields=['status', 'attempts', 'error', 'next_attempt_at'])
+
+    def __str__(self):
+        return f"{self.subject} - {self.get_status_display()}"
+
+    class Meta:
+        verbose_name_plural = "Outbox Emails"
+        verbose_name = "Outbox Email"
+        ordering = ['-created_at']
+
+
+class OutboxAttachment(CoreModel):
+    """Pièce jointe d'un email en attente"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    email = models.ForeignKey(OutboxEmail, on_delete=models.CASCADE, related_name='attachments', verbose_name="Email")
+    file = models.FileField(upload_to='outbox_attachments/', verbose_name="File")
+    filename = models.CharField(max_length=255, verbose_name="File Name")
+    mimetype = models.CharField(max_length=100, default='application/octet-stream', verbose_name="MIME Type")
+    content_id = models.CharField(max_length=255, null=True, blank=True, verbose_name="Content ID", help_text="Set for images inlined in the HTML body")
+
+    def __str__(self):
+        return self.filename
+
+    class Meta:
+        verbose_name_plural = "Outbox Attachments"
+        verbose_name = "Outbox Attachment"
+        ordering = ['created_at']
@@ -0,0 +1,258 @@
+"""
+Pool de processus de rendu WeasyPrint.
+
+Chaque processus du pool charge une fois pour toutes la configuration des polices
+(fontconfig) et pré-analyse les feuilles de style partagées des templates PDF ; un rendu
+ne paie plus que la mise en page du HTML qu'on lui envoie.
+
+Ce module n'importe ni Django ni les modèles : les processus reçoivent du HTML déjà
+rendu par les templates (compilés et mis en cache côté Django) et écrivent un PDF.
+Les dérivés des images uploadées y sont aussi produits : le décodage d'une image
+démesurée est soumis aux mêmes limites qu'un rendu.
+
+Les processus du pool sont bornés en mémoire (espace d'adressage) et en temps CPU par
+rendu : un document pathologique fait échouer son rendu avec RenderLimitExceeded, sans
+emporter le processus appelant. Un processus du pool tué en plein rendu casse le pool,
+qui est alors remplacé au rendu suivant.
+"""
+import os
+import pathlib
+import signal
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import unquote, urlparse
+
+try:
+    import resource
+except ImportError:  # Windows : pas de limites de ressources
+    resource = None
+
+from PIL import Image, ImageOps
+from weasyprint import CSS, HTML, default_url_fetcher
+from weasyprint.text.fonts import FontConfiguration
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# État d'un processus de rendu, initialisé par _init_worker()
+_font_config = None
+_stylesheets = {}
+_allowed_roots = []
+_url_roots = []
+_cpu_limit = 0
+
+
+class RenderLimitExceeded(Exception):
+    """Un rendu a dépassé la mémoire ou le temps CPU alloués à un processus de rendu"""
+
+
+def _cpu_limit_exceeded(signum, frame):
+    raise RenderLimitExceeded(f"PDF render exceeded its CPU time limit ({_cpu_limit}s)")
+
+
+def _init_worker(stylesheets, allowed_roots, memory_limit=0, cpu_limit=0, url_roots=()):
+    """
+    Initialise un processus de rendu : limites de ressources, polices, feuilles de style
+    pré-analysées, racines autorisées. memory_limit en octets, cpu_limit en secondes par rendu.
+    url_roots : paires (préfixe d'URL, dossier) des URLs publiques lues sur le disque.
+    """
+    global _font_config, _stylesheets, _allowed_roots, _url_roots, _cpu_limit
+    if resource is not None:
+        if memory_limit:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        if cpu_limit:
+            _cpu_limit = cpu_limit
+            signal.signal(signal.SIGXCPU, _cpu_limit_exceeded)
+    _allowed_roots = [os.path.realpath(root) for root in allowed_roots if root]
+    _url_roots = [(prefix, root) for prefix, root in url_roots if prefix and root]
+    _font_config = FontConfiguration()
+    _stylesheets = {
+        name: CSS(filename=path, font_config=_font_config, url_fetcher=url_fetcher)
+        for name, path in stylesheets.items()
+    }
+
+
+def url_fetcher(url, timeout=10, ssl_context=None):
+    """
+    url_fetcher WeasyPrint : les fichiers sont lus directement depuis les racines
+    autorisées (MEDIA_ROOT, statiques), sans copie. Les URLs publiques de ces fichiers
+    (images insérées dans attending_note) sont lues sur le disque via url_roots.
+    Tout autre fichier et tout accès réseau sont refusés (le HTML de attending_note est
+    fourni par l'utilisateur).
+    """
+    if url.startswith('data:'):
+        return default_url_fetcher(url, timeout=timeout, ssl_context=ssl_context)
+
+    path = None
+    if url.startswith('file://'):
+        path = unquote(urlparse(url).path)
+    else:
+        for prefix, root in _url_roots:
+            if url.startswith(prefix):
+                path = os.path.join(root, unquote(urlparse(url[len(prefix):]).path))
+                break
+
+    if path is not None:
+        path = os.path.realpath(path)
+        if any(path.startswith(root + os.sep) for root in _allowed_roots):
+            return default_url_fetcher(pathlib.Path(path).as_uri(), timeout=timeout, ssl_context=ssl_context)
+
+    raise ValueError(f"Resource not allowed in PDF rendering: {url}")
+
+
+def _reset_cpu_limit():
+    """La limite RLIMIT_CPU porte sur la vie du processus : la repousser à chaque tâche"""
+    if _cpu_limit:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        resource.setrlimit(resource.RLIMIT_CPU, (int(usage.ru_utime + usage.ru_stime) + _cpu_limit, hard))
+
+
+def _render(html_string, base_url, stylesheets, target, optimize_size):
+    """Rend le HTML dans le processus courant ; écrit dans target (chemin) ou renvoie les octets"""
+    _reset_cpu_limit()
+    try:
+        return HTML(string=html_string, base_url=base_url, url_fetcher=url_fetcher).write_pdf(
+            target,
+            stylesheets=[_stylesheets[name] for name in stylesheets],
+            font_config=_font_config,
+            presentational_hints=True,
+            optimize_size=optimize_size,
+        )
+    except MemoryError:
+        raise RenderLimitExceeded("PDF render exceeded its memory limit")
+
+
+def _resize_image(source_path, target_path, size, crop, quality):
+    """Écrit dans target_path un JPEG de l'image source réduit à size (recadré si crop)"""
+    _reset_cpu_limit()
+    try:
+        with Image.open(source_path) as image:
+            # Décodage JPEG à résolution réduite : évite de décoder les photos en pleine taille
+            image.draft('RGB', (max(size), max(size)))
+            image = to_rgb(ImageOps.exif_transpose(image))
+
+            if crop:
+                image = crop_to_ratio(image, size[0] / size[1])
+            image.thumbnail(size, Image.LANCZOS)
+            image.save(target_path, 'JPEG', quality=quality, optimize=True)
+    except MemoryError:
+        raise RenderLimitExceeded(f"Image resize exceeded its memory limit: {source_path}")
+
+
+def to_rgb(image):
+    """Image en RGB pour un encodage JPEG ; la transparence est aplatie sur fond blanc"""
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+    return image
+
+
+def crop_to_ratio(image, ratio):
+    """Recadre l'image au centre selon un ratio largeur/hauteur (équivalent de object-fit: cover)"""
+    width, height = image.size
+    if width / height > ratio:
+        new_width = round(height * ratio)
+        left = (width - new_width) // 2
+        return image.crop((left, 0, left + new_width, height))
+    new_height = round(width / ratio)
+    top = (height - new_height) // 2
+    return image.crop((0, top, width, top + new_height))
+
+
+def configure(size, stylesheets, allowed_roots, memory_limit=0, cpu_limit=0, url_roots=()):
+    """
+    Démarre le pool (size processus) si ce n'est pas déjà fait.
+    Avec size=0, les rendus sont faits dans le processus appelant, sans limites de ressources.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            return
+        if size:
+            # spawn plutôt que fork : l'appelant peut avoir des threads et des connexions ouvertes
+            _pool = ProcessPoolExecutor(
+                max_workers=size,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(stylesheets, allowed_roots, memory_limit, cpu_limit, url_roots),
+            )
+        else:
+            _init_worker(stylesheets, allowed_roots, url_roots=url_roots)
+            _pool = False
+
+
+def submit(html_string, base_url, stylesheets, target=None, optimize_size=('fonts',)):
+    """
+    Soumet un rendu au pool ; renvoie un Future (résultat de write_pdf).
+    stylesheets : noms des feuilles de style pré-analysées, appliquées dans l'ordre.
+    """
+    return _submit(_render, html_string, base_url, stylesheets, target, optimize_size)
+
+
+def submit_image(source_path, target_path, size, crop=False, quality=85):
+    """
+    Soumet au pool la réduction d'une image en JPEG de size pixels (largeur, hauteur) au
+    plus, recadrée au ratio de size si crop ; renvoie un Future.
+    """
+    return _submit(_resize_image, source_path, target_path, size, crop, quality)
+
+
+def _submit(fn, *args):
+    """Exécute fn(*args) dans le pool (ou dans le processus courant si size=0) ; renvoie un Future"""
+    if _pool is None:
+        raise RuntimeError("Render pool is not configured")
+
+    if _pool:
+        pool = _pool
+        try:
+            inner = pool.submit(fn, *args)
+        except BrokenProcessPool:
+            _discard(pool)
+            raise RenderLimitExceeded("PDF render process died; the render pool was restarted")
+        future = Future()
+        inner.add_done_callback(lambda inner: _forward(inner, future, pool))
+        return future
+
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def _forward(inner, future, pool):
+    """Reporte le résultat d'un rendu du pool ; un processus mort (limite noyau) devient RenderLimitExceeded"""
+    error = inner.exception()
+    if isinstance(error, BrokenProcessPool):
+        _discard(pool)
+        future.set_exception(RenderLimitExceeded("PDF render process died (memory or CPU limit exceeded?)"))
+    elif error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(inner.result())
+
+
+def _discard(pool):
+    """Abandonne un pool cassé ; le prochain configure() en démarrera un nouveau"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def shutdown():
+    """Arrête le pool ; le prochain configure() en démarrera un nouveau"""
+    global _pool
+    with _pool_lock:
+        if _pool:
+            _pool.shutdown()
+        _pool = None
@@ -6,6 +6,7 @@ from rest_framework.permissions import IsAuthenticated
 from visitationbookapi.models import *
 from visitationbookapi.utils import *
 from django.utils import timezone
+from django.db import transaction
 from decimal import Decimal
 import datetime
 import stripe
@@ -455,6 +456,7 @@ class BookPurchaseSerializer(serializers.ModelSerializer):
     custom_cover = FullURLFileField()
     deceased_image = FullURLFileField()
     pdf_file = FullURLFileField()
+    web_pdf_file = FullURLFileField(read_only=True)
     attending_note = serializers.CharField(required=False, allow_null=True, allow_blank=True)
     attending_note_pdf = FullURLFileField()
     subscription_id = serializers.UUIDField(write_only=True, required=False)
@@ -465,12 +467,12 @@ class BookPurchaseSerializer(serializers.ModelSerializer):
         fields = ['id', 'book_id', 'book', 'obituary_id', 'obituary', 'custom_cover', 'custom_text_color', 'payment_status', 'purchase_date',
                   'payment_transaction', 'deceased_image', 'deceased_name', 'date_of_birth', 'date_of_death', 
                   'allow_picture', 'allow_name', 'allow_address', 'allow_email', 'allow_special_notes',
-                  'guests', 'is_both', 'pdf_file', 'is_complete', 'visit_count', 'attending_note', 'attending_note_pdf', 'subscription', 'subscription_id']
-        read_only_fields = ['purchase_date', 'user', 'payment_status', 'visit_count']
+                  'guests', 'is_both', 'pdf_file', 'pdf_volumes', 'web_pdf_file', 'web_pdf_volumes', 'pdf_stale', 'pdf_error', 'is_complete', 'visit_count', 'attending_note', 'attending_note_pdf', 'thank_you_delivery', 'subscription', 'subscription_id']
+        read_only_fields = ['purchase_date', 'user', 'payment_status', 'visit_count', 'pdf_volumes', 'web_pdf_volumes', 'pdf_stale', 'pdf_error']
         
     def get_guests(self, obj):
-        guest_info = GuestInfo.objects.filter(book_purchase=obj)
-        return GuestInfoSerializer(guest_info, many=True).data
+        # guest_infos est préchargé par BookPurchaseViewSet.get_queryset()
+        return GuestInfoSerializer(obj.guest_infos.all(), many=True).data
         
     def validate_custom_cover(self, value):
         if value and not value.name.lower().endswith(('.png', '.jpg', '.jpeg')):
@@ -538,6 +540,23 @@ class BookPurchaseSerializer(serializers.ModelSerializer):
         return instance
 
 
+class PdfRenderJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PdfRenderJob
+        fields = ['id', 'profile', 'status', 'created_at', 'run_after', 'started_at', 'finished_at', 'duration', 'coalesced_requests', 'error']
+        read_only_fields = fields
+
+
+class ThankYouNoteStatusSerializer(serializers.ModelSerializer):
+    """Résultat de l'envoi de la note de remerciement à un visiteur"""
+    sent_at = serializers.DateTimeField(source='thank_you_email.sent_at', read_only=True, default=None)
+
+    class Meta:
+        model = GuestInfo
+        fields = ['id', 'guest_name', 'guest_email', 'thank_you_status', 'thank_you_requested_at', 'sent_at', 'thank_you_error']
+        read_only_fields = fields
+
+
 class BookPurchaseSerializerLimited(serializers.ModelSerializer):
     book = BookSerializer(read_only=True)
     obituary = ObituarySerializer(read_only=True)
@@ -545,12 +564,13 @@ class BookPurchaseSerializerLimited(serializers.ModelSerializer):
     custom_cover = FullURLFileField()
     deceased_image = FullURLFileField()
     pdf_file = FullURLFileField()
+    web_pdf_file = FullURLFileField(read_only=True)
     attending_note_pdf = FullURLFileField()
 
     class Meta:
         model = BookPurchase
         fields = ['id', 'book', 'obituary', 'custom_cover', 'custom_text_color', 'deceased_name', 'date_of_birth', 'date_of_death', 'deceased_image',
-                  'allow_picture', 'allow_name', 'allow_address', 'allow_email', 'allow_special_notes', 'guests', 'pdf_file', 'is_complete', 'attending_note_pdf']
+                  'allow_picture', 'allow_name', 'allow_address', 'allow_email', 'allow_special_notes', 'guests', 'pdf_file', 'pdf_volumes', 'web_pdf_file', 'web_pdf_volumes', 'is_complete', 'attending_note_pdf']
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
@@ -561,8 +581,8 @@ class BookPurchaseSerializerLimited(serializers.ModelSerializer):
         return representation
     
     def get_guests(self, obj):
-        guest_info = GuestInfo.objects.filter(book_purchase=obj)
-        return GuestInfoSerializer(guest_info, many=True).data
+        # guest_infos est préchargé par BookPurchaseViewSet.get_queryset()
+        return GuestInfoSerializer(obj.guest_infos.all(), many=True).data
     
     
 class GuestInfoSerializer(serializers.ModelSerializer):
@@ -573,8 +593,8 @@ class GuestInfoSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = GuestInfo
-        fields = ['id', 'book_purchase_id', 'guest_picture', 'guest_name', 'guest_address', 'guest_email', 'special_notes', 'has_attending_note', 'thank_you_pdf']
-        read_only_fields = ['id', 'has_attending_note']
+        fields = ['id', 'book_purchase_id', 'guest_picture', 'guest_name', 'guest_address', 'guest_email', 'special_notes', 'has_attending_note', 'thank_you_pdf', 'thank_you_status']
+        read_only_fields = ['id', 'has_attending_note', 'thank_you_status']
         
     def get_has_attending_note(self, obj):
         """
@@ -620,27 +640,10 @@ class GuestInfoSerializer(serializers.ModelSerializer):
         guest_info = GuestInfo.objects.create(book_purchase=book_purchase, **validated_data)
         
         if book_purchase.attending_note and guest_info.guest_email:
-            try:
-                context = {
-                    'guest_name': guest_info.guest_name or 'Guest',
-                    'guest_address': guest_info.guest_address,
-                    'guest_email': guest_info.guest_email,
-                    'deceased_name': book_purchase.deceased_name,
-                    'attending_note': book_purchase.attending_note,
-                    'book_purchaser_name': (book_purchase.user.full_name or book_purchase.user.email)
-                }
-                
-                context['attending_note'] = substitute_variables(context['attending_note'], context)
-                
-                send_thank_you_email(
-                    guest_info.guest_email, 
-                    "Thank you for your condolences", 
-                    context, 
-                    book_purchase,
-                    guest_info
-                )
-            except Exception as e:
-                print(f"Error sending thank you note: {e}")
+            # La note est rendue et envoyée par `run_pdf_worker`, une fois le guest enregistré :
+            # la requête du guest n'attend ni le rendu du PDF ni l'envoi de l'email
+            guest_info.thank_you_status = 'pending'
+            transaction.on_commit(guest_info.request_thank_you_note)
         
         return guest_info
 
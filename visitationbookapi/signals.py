@@ -1,14 +1,12 @@
-from django.db.models.signals import post_save, pre_save
-from django.core.mail import EmailMultiAlternatives
+from django.db.models.signals import post_save, pre_save, post_delete
 from django.dispatch import receiver
-from django.template.loader import render_to_string
 from django.urls import reverse
 from django_rest_passwordreset.signals import reset_password_token_created
 from visitationbook import settings
 from django.db import transaction
 from visitationbookapi.models import *
 import stripe
-from django.contrib.staticfiles.storage import staticfiles_storage
+import shutil
 
 
 @receiver(reset_password_token_created)
@@ -24,8 +22,6 @@ def password_reset_token_created(sender, instance, reset_password_token, *args,
     :return:
     """
     
-    logo_url = f'{settings.BASE_URL}{staticfiles_storage.url("images/logo.png")}'
-    
     # send an e-mail to the user
     otp_code = reset_password_token.key
     context = {
@@ -37,26 +33,46 @@ def password_reset_token_created(sender, instance, reset_password_token, *args,
             instance.request.build_absolute_uri(reverse('password_reset:reset-password-confirm')), 
             otp_code
         ),
-        'logo_url': logo_url
     }
 
-    email_html_message = render_to_string('email/user_reset_password.html', context)
-    email_plaintext_message = render_to_string('email/user_reset_password.txt', context)
+    email_plaintext_message, email_html_message = render_email('user_reset_password', context)
 
-    msg = EmailMultiAlternatives(
+    queue_email(
         "Password Reset for Visitation Book",
         email_plaintext_message,
-        settings.DEFAULT_FROM_EMAIL,
-        [reset_password_token.user.email]
+        [reset_password_token.user.email],
+        html_body=email_html_message,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        kind='password_reset',
     )
-    msg.attach_alternative(email_html_message, "text/html")
-    msg.send()
 
 
 @receiver(post_save, sender=GuestInfo)
 def update_pdf_on_guest_info_change(sender, instance, created, **kwargs):
-    # Mettre à jour le PDF chaque fois qu'un GuestInfo est créé ou modifié
-    update_pdf(instance.book_purchase)
+    # Le PDF devient obsolète chaque fois qu'un GuestInfo est créé ou modifié
+    instance.book_purchase.mark_pdf_stale()
+
+
+@receiver(post_delete, sender=GuestInfo)
+def update_pdf_on_guest_info_delete(sender, instance, **kwargs):
+    delete_pdf_images(instance.guest_picture)
+    try:
+        book_purchase = instance.book_purchase
+    except BookPurchase.DoesNotExist:
+        # Suppression en cascade du book purchase
+        return
+    book_purchase.mark_pdf_stale()
+    
+
+
+@receiver(post_delete, sender=BookPurchase)
+def delete_pdf_segments_on_book_purchase_delete(sender, instance, **kwargs):
+    # Supprimer les segments PDF et les vignettes en cache du livre
+    shutil.rmtree(os.path.join(settings.PDF_SEGMENT_CACHE_DIR, str(instance.id)), ignore_errors=True)
+    shutil.rmtree(os.path.join(settings.PDF_PREVIEW_CACHE_DIR, str(instance.id)), ignore_errors=True)
+    # Ainsi que les dérivés de ses images
+    delete_pdf_images(instance.deceased_image)
+    delete_pdf_images(instance.custom_cover)
     
             
 def create_stripe_customer(user):
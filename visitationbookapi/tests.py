@@ -1,3 +1,541 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+from PIL import Image
+from pypdf import PdfWriter
+from django.conf import settings
+from django.core import signing
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from visitationbook import settings as vb_settings
+from visitationbookapi import render_pool
+from visitationbookapi.models import *
+from visitationbookapi.utils import (
+    THANK_YOU_PDF_SALT, compute_pdf_fingerprint, generate_pdf, get_pdf_previews, get_pdf_volume_count, get_pdf_volume_names,
+    get_pdf_volume_size, prepare_email_image, queue_email, store_thank_you_pdf, submit_pdf_render, update_pdf,
+)
+
+
+class BookPurchaseTestCase(TestCase):
+    """Un utilisateur abonné et de quoi lui créer des livres, les fichiers dans un MEDIA_ROOT temporaire"""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # Les caches du pipeline PDF sont lus dans visitationbook.settings
+        for name in ('PDF_SEGMENT_CACHE_DIR', 'PDF_IMAGE_CACHE_DIR', 'PDF_PREVIEW_CACHE_DIR'):
+            patcher = mock.patch.object(vb_settings, name, os.path.join(media_root, name.lower()))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        with mock.patch('visitationbookapi.signals.create_stripe_customer'):
+            self.user = User.objects.create_user(email='family@example.com', password='password', full_name='Family')
+        self.book = Book.objects.create(title='Classic', price=10)
+        self.payment_method = PaymentMethod.objects.create(user=self.user, card_brand='visa', last4='4242')
+        plan = SubscriptionPlan.objects.create(name='Pro', plan_type='monthly', book_type='both', price=100, max_books=100, description='Pro')
+        SubscriptionFeature.objects.create(plan=plan, name='Unlimited guests', description='Unlimited guests')
+        SubscriptionFeature.objects.create(plan=plan, name='Print PDF', description='Print PDF')
+        self.subscription = FuneralHomeSubscription.objects.create(
+            user=self.user,
+            plan=plan,
+            end_date=timezone.now() + timezone.timedelta(days=30),
+            payment_transaction=self.create_payment_transaction(),
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_payment_transaction(self):
+        return PaymentTransaction.objects.create(
+            user=self.user, payment_method=self.payment_method, amount=10, tax=1.5, total=11.5, status='completed'
+        )
+
+    def create_book_purchase(self, guests):
+        obituary = Obituary.objects.create(user=self.user, deceased_name='John Doe')
+        book_purchase = BookPurchase.objects.create(
+            user=self.user,
+            book=self.book,
+            obituary=obituary,
+            payment_transaction=self.create_payment_transaction(),
+            subscription=self.subscription,
+            deceased_name='John Doe',
+        )
+        for i in range(guests):
+            GuestInfo.objects.create(book_purchase=book_purchase, guest_name=f'Guest {i}', guest_email=f'guest{i}@example.com')
+        return book_purchase
+
+
+class BookPurchaseQueryCountTests(BookPurchaseTestCase):
+    """Lister ou afficher des livres coûte un nombre constant de requêtes"""
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_list_query_count_does_not_grow_with_books_and_guests(self):
+        self.create_book_purchase(guests=1)
+        baseline = self.count_queries('/api/book-purchases/')
+
+        for _ in range(4):
+            self.create_book_purchase(guests=5)
+        with self.assertNumQueries(baseline):
+            response = self.client.get('/api/book-purchases/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_retrieve_query_count_does_not_grow_with_guests(self):
+        book_purchase = self.create_book_purchase(guests=1)
+        baseline = self.count_queries(f'/api/book-purchases/{book_purchase.id}/')
+
+        for i in range(10):
+            GuestInfo.objects.create(book_purchase=book_purchase, guest_name=f'Late guest {i}')
+        with self.assertNumQueries(baseline):
+            response = self.client.get(f'/api/book-purchases/{book_purchase.id}/')
+        self.assertEqual(len(response.data['guests']), 11)
+
+
+class BookPurchasePaginationTests(BookPurchaseTestCase):
+    """Les actions paginées le restent quelle que soit DEFAULT_PAGINATION_CLASS"""
+
+    def setUp(self):
+        super().setUp()
+        self.book_purchase = self.create_book_purchase(guests=1)
+        BookPurchase.objects.filter(pk=self.book_purchase.pk).update(is_complete=True)
+
+    @mock.patch('visitationbookapi.viewsets.get_pdf_previews', side_effect=lambda book_purchase, pages, page_counts: [{'page': page} for page in pages])
+    @mock.patch('visitationbookapi.viewsets.count_pdf_pages', return_value=25)
+    @mock.patch('visitationbookapi.viewsets.get_pdf_volume_names', return_value=['book.pdf'])
+    @mock.patch.object(BookPurchase, 'can_serve_pdf', return_value=True)
+    def test_previews_are_paginated(self, *mocks):
+        response = self.client.get(f'/api/book-purchases/{self.book_purchase.id}/previews/?page=3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 25)
+        self.assertEqual([preview['page'] for preview in response.data['results']], [21, 22, 23, 24, 25])
+
+    def test_thank_you_notes_are_paginated(self):
+        for i in range(11):
+            GuestInfo.objects.create(book_purchase=self.book_purchase, guest_name=f'Late guest {i}', guest_email=f'late{i}@example.com')
+        GuestInfo.objects.filter(book_purchase=self.book_purchase).update(thank_you_status='sent')
+
+        response = self.client.get(f'/api/book-purchases/{self.book_purchase.id}/thank_you_notes/?page=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 12)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertEqual(response.data['statuses']['sent'], 12)
+
+
+    def test_send_to_all_skips_notes_already_in_progress(self):
+        BookPurchase.objects.filter(pk=self.book_purchase.pk).update(attending_note='<p>Thank you [guest_name]</p>')
+        for status in ('queued', 'sent', 'failed'):
+            GuestInfo.objects.create(book_purchase=self.book_purchase, guest_name=status, guest_email=f'{status}@example.com')
+            GuestInfo.objects.filter(guest_name=status).update(thank_you_status=status)
+
+        response = self.client.post(f'/api/book-purchases/{self.book_purchase.id}/send_thank_you_notes/')
+        self.assertEqual(response.status_code, 202)
+        # Le guest du fixture, puis les notes envoyées ou en échec ; pas celle encore dans l'outbox
+        self.assertEqual(response.data['scheduled'], 3)
+        self.assertEqual(GuestInfo.objects.get(guest_name='queued').thank_you_status, 'queued')
+
+
+class BookPurchaseDownloadTests(BookPurchaseTestCase):
+    """Un PDF obsolète n'est jamais rendu pendant la requête de téléchargement"""
+
+    def setUp(self):
+        super().setUp()
+        self.book_purchase = self.create_book_purchase(guests=1)
+        BookPurchase.objects.filter(pk=self.book_purchase.pk).update(is_complete=True)
+        self.url = f'/api/book-purchases/{self.book_purchase.id}/download_pdf/'
+
+    @mock.patch('visitationbookapi.utils.update_pdf')
+    def test_stale_pdf_is_queued(self, update_pdf):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'queued')
+        update_pdf.assert_not_called()
+
+        # Les téléchargements suivants rejoignent le même job
+        self.assertEqual(self.client.get(self.url).status_code, 202)
+        self.assertEqual(self.book_purchase.pdf_render_jobs.get(profile='print').coalesced_requests, 1)
+
+    def test_download_does_not_wait_for_the_coalescing_window(self):
+        # Rendu demandé en arrière-plan par une modification, puis téléchargement
+        job = self.book_purchase.request_pdf_render('print')
+        self.assertGreater(job.run_after, timezone.now())
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 202)
+        job.refresh_from_db()
+        self.assertLessEqual(job.run_after, timezone.now())
+
+    def test_stale_flag_without_visible_change_serves_the_pdf(self):
+        name = self.book_purchase.pdf_file.storage.save('book_purchase_pdfs/book.pdf', ContentFile(b'%PDF-1.4'))
+        BookPurchase.objects.filter(pk=self.book_purchase.pk).update(
+            pdf_file=name, pdf_stale=True, pdf_fingerprint=compute_pdf_fingerprint(self.book_purchase),
+        )
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(BookPurchase.objects.get(pk=self.book_purchase.pk).pdf_stale)
+        self.assertFalse(self.book_purchase.pdf_render_jobs.exists())
+
+    def test_render_in_progress_returns_conflict(self):
+        with pdf_render_lock(self.book_purchase):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(self.book_purchase.pdf_render_jobs.exists())
+
+    @mock.patch('visitationbookapi.viewsets.get_pdf_previews', return_value=[])
+    @mock.patch('visitationbookapi.viewsets.count_pdf_pages', return_value=1)
+    def test_previews_served_while_web_refresh_is_pending(self, *mocks):
+        BookPurchase.objects.filter(pk=self.book_purchase.pk).update(web_pdf_file='book_purchase_web_pdfs/web.pdf', web_pdf_volumes=1)
+        self.book_purchase.request_pdf_render('web')
+
+        response = self.client.get(f'/api/book-purchases/{self.book_purchase.id}/previews/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_previews_without_web_pdf_are_queued(self):
+        response = self.client.get(f'/api/book-purchases/{self.book_purchase.id}/previews/')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['profile'], 'web')
+
+
+class ThankYouPdfDownloadTests(BookPurchaseTestCase):
+    """Le PDF de remerciement est servi via un lien signé et revalidé par le navigateur"""
+
+    def setUp(self):
+        super().setUp()
+        self.guest_info = self.create_book_purchase(guests=1).guest_infos.get()
+        name = self.guest_info.thank_you_pdf.storage.save('thank_you_pdfs/note.pdf', ContentFile(b'%PDF-1.4'))
+        GuestInfo.objects.filter(pk=self.guest_info.pk).update(thank_you_pdf=name)
+        token = signing.TimestampSigner(salt=THANK_YOU_PDF_SALT).sign(str(self.guest_info.id))
+        self.url = f'/api/guest-infos/{self.guest_info.id}/download_thank_you_pdf/?token={token}'
+
+    def test_conditional_get_returns_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_expired_link_is_gone(self):
+        expired = time.time() + settings.THANK_YOU_LINK_MAX_AGE + 1
+        with mock.patch('django.core.signing.time.time', return_value=expired):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 410)
+
+    def test_tampered_link_is_forbidden(self):
+        response = self.client.get(self.url + 'x')
+        self.assertEqual(response.status_code, 403)
+
+    def test_new_pdf_replaces_the_previous_one(self):
+        guest_info = GuestInfo.objects.get(pk=self.guest_info.pk)
+        old_name = guest_info.thank_you_pdf.name
+        store_thank_you_pdf(guest_info, b'%PDF-1.4 resend')
+
+        storage = guest_info.thank_you_pdf.storage
+        self.assertNotEqual(guest_info.thank_you_pdf.name, old_name)
+        self.assertTrue(storage.exists(guest_info.thank_you_pdf.name))
+        self.assertFalse(storage.exists(old_name))
+
+
+def write_fake_pdf(book_purchase, target, *args):
+    target.write(b'%PDF-1.4')
+
+
+@mock.patch('visitationbookapi.utils.generate_pdf', side_effect=write_fake_pdf)
+class UpdatePdfTests(BookPurchaseTestCase):
+    """Un PDF n'est re-rendu que si son contenu change, et remplacé sans interruption"""
+
+    def setUp(self):
+        super().setUp()
+        self.book_purchase = self.create_book_purchase(guests=1)
+
+    def test_unchanged_fingerprint_skips_render(self, generate_pdf):
+        self.assertTrue(update_pdf(self.book_purchase))
+        self.assertFalse(update_pdf(self.book_purchase))
+        self.assertEqual(generate_pdf.call_count, 1)
+
+        GuestInfo.objects.create(book_purchase=self.book_purchase, guest_name='Late guest')
+        self.assertTrue(update_pdf(self.book_purchase))
+        self.assertEqual(generate_pdf.call_count, 2)
+
+    def test_new_render_replaces_previous_file(self, generate_pdf):
+        update_pdf(self.book_purchase)
+        old_name = self.book_purchase.pdf_file.name
+
+        GuestInfo.objects.create(book_purchase=self.book_purchase, guest_name='Late guest')
+        update_pdf(self.book_purchase)
+
+        storage = self.book_purchase.pdf_file.storage
+        self.assertNotEqual(BookPurchase.objects.get(pk=self.book_purchase.pk).pdf_file.name, old_name)
+        self.assertTrue(storage.exists(self.book_purchase.pdf_file.name))
+        self.assertFalse(storage.exists(old_name))
+
+    def test_failed_render_keeps_previous_file(self, generate_pdf):
+        update_pdf(self.book_purchase)
+        old_name = self.book_purchase.pdf_file.name
+        files_before = self.book_purchase.pdf_file.storage.listdir(os.path.dirname(old_name))[1]
+
+        GuestInfo.objects.create(book_purchase=self.book_purchase, guest_name='Late guest')
+        generate_pdf.side_effect = RuntimeError('render failed')
+        with self.assertRaises(RuntimeError):
+            update_pdf(self.book_purchase)
+
+        book_purchase = BookPurchase.objects.get(pk=self.book_purchase.pk)
+        self.assertEqual(book_purchase.pdf_file.name, old_name)
+        self.assertTrue(book_purchase.pdf_stale)
+        self.assertEqual(book_purchase.pdf_file.storage.listdir(os.path.dirname(old_name))[1], files_before)
+
+
+
+@mock.patch.object(vb_settings, 'PDF_VOLUME_MAX_GUESTS', 10)
+class PdfVolumeTests(BookPurchaseTestCase):
+    """Un grand livre est découpé en volumes d'un nombre borné de visiteurs"""
+
+    def add_guests(self, book_purchase, count):
+        start = book_purchase.guest_infos.count()
+        GuestInfo.objects.bulk_create([GuestInfo(book_purchase=book_purchase, guest_name=f'Guest {start + i}') for i in range(count)])
+
+    def test_volume_size_is_rounded_to_full_pages(self):
+        self.assertEqual(get_pdf_volume_size(), 8)
+        with mock.patch.object(vb_settings, 'PDF_VOLUME_MAX_GUESTS', 3):
+            self.assertEqual(get_pdf_volume_size(), 4)
+        with mock.patch.object(vb_settings, 'PDF_VOLUME_MAX_GUESTS', 0):
+            self.assertEqual(get_pdf_volume_size(), 0)
+            self.assertEqual(get_pdf_volume_count(5000), 1)
+
+    def test_volume_count_has_no_empty_final_volume(self):
+        self.assertEqual([get_pdf_volume_count(count) for count in (0, 1, 8, 9, 16, 17)], [1, 1, 1, 2, 2, 3])
+
+    @mock.patch('visitationbookapi.utils.render_pdf_segments', return_value=[])
+    def test_volume_contains_only_its_guests(self, render_pdf_segments):
+        book_purchase = self.create_book_purchase(guests=0)
+        self.add_guests(book_purchase, 10)
+
+        guest_names = []
+        for volume in (1, 2):
+            generate_pdf(book_purchase, volume=volume, used_segments=set())
+            segments = render_pdf_segments.call_args.args[1]
+            self.assertEqual([segment for segment, _, _ in segments][0], 'cover')
+            self.assertEqual(segments[0][1]['volume_count'], 2)
+            guest_names.append([card['name'] for _, context, _ in segments for page in context.get('visitor_pages', []) for card in page])
+
+        self.assertEqual(guest_names, [[f'Guest {i}' for i in range(8)], ['Guest 8', 'Guest 9']])
+
+    @mock.patch('visitationbookapi.utils.generate_pdf', side_effect=write_fake_pdf)
+    def test_volume_names_follow_the_swap(self, generate_pdf):
+        book_purchase = self.create_book_purchase(guests=0)
+        self.add_guests(book_purchase, 9)
+        # Dossier des segments créé par le vrai generate_pdf, nettoyé après le rendu des volumes
+        os.makedirs(os.path.join(vb_settings.PDF_SEGMENT_CACHE_DIR, str(book_purchase.id)))
+        update_pdf(book_purchase)
+        old_names = get_pdf_volume_names(book_purchase)
+        self.assertEqual(book_purchase.pdf_volumes, 2)
+        self.assertEqual(old_names[1], old_names[0].replace('.pdf', '_vol2.pdf'))
+
+        self.add_guests(book_purchase, 8)
+        update_pdf(book_purchase)
+
+        book_purchase = BookPurchase.objects.get(pk=book_purchase.pk)
+        names = get_pdf_volume_names(book_purchase)
+        storage = book_purchase.pdf_file.storage
+        self.assertEqual(book_purchase.pdf_volumes, 3)
+        self.assertTrue(all(storage.exists(name) for name in names))
+        self.assertFalse(any(storage.exists(name) for name in old_names))
+
+    def test_download_of_unknown_volume_is_not_found(self):
+        book_purchase = self.create_book_purchase(guests=0)
+        name = book_purchase.pdf_file.storage.save('book_purchase_pdfs/book.pdf', ContentFile(b'%PDF-1.4'))
+        book_purchase.pdf_file.storage.save('book_purchase_pdfs/book_vol2.pdf', ContentFile(b'%PDF-1.4'))
+        BookPurchase.objects.filter(pk=book_purchase.pk).update(is_complete=True, pdf_file=name, pdf_volumes=2, pdf_stale=False)
+        url = f'/api/book-purchases/{book_purchase.id}/download_pdf/'
+
+        self.assertEqual(self.client.get(url, {'volume': 2}).status_code, 200)
+        self.assertEqual(self.client.get(url, {'volume': 3}).status_code, 404)
+        self.assertEqual(self.client.get(url, {'volume': 'last'}).status_code, 400)
+
+
+
+class PdfSegmentCacheTests(BookPurchaseTestCase):
+    """Seuls les segments du livre qui ont changé sont re-rendus, séparément pour chaque profil"""
+
+    @mock.patch('visitationbookapi.utils.submit_pdf_render', wraps=submit_pdf_render)
+    def test_only_changed_segments_are_rendered(self, submit):
+        book_purchase = self.create_book_purchase(guests=5)
+
+        # Couverture, deux pages de visiteurs, page de fin
+        generate_pdf(book_purchase)
+        self.assertEqual(submit.call_count, 4)
+
+        submit.reset_mock()
+        generate_pdf(book_purchase)
+        self.assertEqual(submit.call_count, 0)
+
+        # Seule la dernière page de visiteurs change
+        GuestInfo.objects.create(book_purchase=book_purchase, guest_name='Late guest')
+        generate_pdf(book_purchase)
+        self.assertEqual(submit.call_count, 1)
+
+        # Le profil web a ses propres segments
+        submit.reset_mock()
+        generate_pdf(book_purchase, profile='web')
+        self.assertEqual(submit.call_count, 4)
+
+
+
+class PdfPreviewTests(BookPurchaseTestCase):
+    """Les pages des vignettes sont numérotées à la suite sur tous les volumes du PDF web"""
+
+    def save_pdf(self, storage, name, page_count, height):
+        writer = PdfWriter()
+        for _ in range(page_count):
+            writer.add_blank_page(200, height)
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        return storage.save(name, ContentFile(buffer.getvalue()))
+
+    def test_pages_map_to_their_volume(self):
+        book_purchase = self.create_book_purchase(guests=0)
+        storage = book_purchase.web_pdf_file.storage
+        # Pages paysage dans le premier volume, portrait dans le second
+        name = self.save_pdf(storage, 'book_purchase_web_pdfs/book.pdf', 3, 100)
+        self.save_pdf(storage, name.replace('.pdf', '_vol2.pdf'), 3, 400)
+        BookPurchase.objects.filter(pk=book_purchase.pk).update(web_pdf_file=name, web_pdf_volumes=2, web_pdf_fingerprint='fingerprint')
+        book_purchase.refresh_from_db()
+
+        previews = get_pdf_previews(book_purchase, [3, 4], [3, 3])
+
+        self.assertEqual([(preview['page'], preview['volume'], preview['kind']) for preview in previews], [(3, 1, 'footer'), (4, 2, 'cover')])
+        self.assertLess(previews[0]['height'], previews[0]['width'])
+        self.assertGreater(previews[1]['height'], previews[1]['width'])
+
+
+class PdfRenderJobTests(BookPurchaseTestCase):
+    """Les demandes de rendu rapprochées d'un livre sont regroupées en un seul job"""
+
+    def setUp(self):
+        super().setUp()
+        self.book_purchase = self.create_book_purchase(guests=1)
+
+    def test_requests_coalesce_into_queued_job(self):
+        job = self.book_purchase.request_pdf_render('print')
+        for _ in range(3):
+            self.assertEqual(self.book_purchase.request_pdf_render('print'), job)
+        job.refresh_from_db()
+        self.assertEqual(job.coalesced_requests, 3)
+
+        # Un autre profil a son propre job
+        self.assertNotEqual(self.book_purchase.request_pdf_render('web'), job)
+
+    def test_request_after_claim_queues_new_job(self):
+        job = self.book_purchase.request_pdf_render('print')
+        PdfRenderJob.objects.filter(pk=job.pk).update(run_after=None)
+        self.assertEqual(PdfRenderJob.claim_next(), job)
+
+        # Le job en cours a peut-être déjà lu le livre : une nouvelle demande n'y est pas fusionnée
+        self.assertNotEqual(self.book_purchase.request_pdf_render('print'), job)
+        self.assertEqual(self.book_purchase.pdf_render_jobs.filter(status='queued').count(), 1)
+
+
+class OutboxEmailTests(TestCase):
+    """Un email dont l'envoi échoue est réessayé avec un délai croissant, puis abandonné"""
+
+    def setUp(self):
+        self.email = queue_email('Subject', 'Body', ['guest@example.com'])
+
+    def fail_next_attempt(self):
+        OutboxEmail.objects.filter(pk=self.email.pk).update(next_attempt_at=None)
+        [email] = OutboxEmail.claim_batch(10)
+        email.mark_failed('SMTP down')
+        return email
+
+    def test_failed_email_is_retried_with_backoff(self):
+        email = self.fail_next_attempt()
+        self.assertEqual(email.status, 'queued')
+        first_delay = email.next_attempt_at - timezone.now()
+        self.assertAlmostEqual(first_delay.total_seconds(), settings.EMAIL_OUTBOX_RETRY_DELAY, delta=5)
+        # Pas de nouvel essai avant la fin du délai
+        self.assertEqual(OutboxEmail.claim_batch(10), [])
+
+        email = self.fail_next_attempt()
+        second_delay = email.next_attempt_at - timezone.now()
+        self.assertAlmostEqual(second_delay.total_seconds(), settings.EMAIL_OUTBOX_RETRY_DELAY * 2, delta=5)
+
+    def test_email_is_given_up_after_max_attempts(self):
+        for _ in range(settings.EMAIL_OUTBOX_MAX_ATTEMPTS):
+            email = self.fail_next_attempt()
+        self.assertEqual(email.status, 'failed')
+        self.assertEqual(email.attempts, settings.EMAIL_OUTBOX_MAX_ATTEMPTS)
+        self.assertEqual(OutboxEmail.claim_batch(10), [])
+
+    @mock.patch('visitationbookapi.management.commands.send_queued_emails.get_connection')
+    def test_build_error_does_not_close_the_connection(self, get_connection):
+        broken = queue_email('Broken', 'Body', ['broken@example.com'])
+        OutboxAttachment.objects.create(email=broken, filename='missing.pdf', mimetype='application/pdf', file='outbox_attachments/missing.pdf')
+
+        call_command('send_queued_emails', '--once', stdout=io.StringIO())
+
+        connection = get_connection.return_value
+        connection.send_messages.assert_called_once()
+        # Fermée une seule fois, en fin de lot
+        connection.close.assert_called_once()
+        self.assertEqual(OutboxEmail.objects.get(pk=self.email.pk).status, 'sent')
+        self.assertEqual(OutboxEmail.objects.get(pk=broken.pk).status, 'queued')
+
+
+class RenderPoolUrlFetcherTests(TestCase):
+    """Les images d'une note sont lues sur le disque, sans accès réseau ni sortie des racines autorisées"""
+
+    def setUp(self):
+        media_root = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, media_root)
+        with open(os.path.join(media_root, 'note image.png'), 'wb') as f:
+            f.write(b'png')
+        self.media_root = media_root
+        for name, value in [('_allowed_roots', [media_root]), ('_url_roots', [('https://example.com/media/', media_root)])]:
+            patcher = mock.patch.object(render_pool, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @mock.patch.object(render_pool, 'default_url_fetcher')
+    def test_public_media_url_is_read_from_disk(self, default_url_fetcher):
+        render_pool.url_fetcher('https://example.com/media/note%20image.png?v=1')
+        self.assertEqual(default_url_fetcher.call_args.args[0], f'file://{self.media_root}/note%20image.png')
+
+    def test_other_urls_are_rejected(self):
+        for url in ('https://example.com/media/../secret.txt', 'https://other.example.com/image.png', 'file:///etc/passwd'):
+            with self.assertRaises(ValueError):
+                render_pool.url_fetcher(url)
+
+
+class EmailImageTests(TestCase):
+    """Les images jointes aux emails sont réduites dans le pool de rendu"""
+
+    def test_image_is_downscaled_to_jpeg(self):
+        buffer = io.BytesIO()
+        Image.new('RGBA', (settings.EMAIL_IMAGE_MAX_SIZE * 2, settings.EMAIL_IMAGE_MAX_SIZE), (255, 0, 0, 128)).save(buffer, 'PNG')
+        name, content, mimetype = prepare_email_image(SimpleUploadedFile('photo.png', buffer.getvalue(), 'image/png'))
+        self.addCleanup(content.close)
+
+        self.assertEqual((name, mimetype), ('photo.jpg', 'image/jpeg'))
+        with Image.open(content) as image:
+            self.assertEqual(image.format, 'JPEG')
+            self.assertEqual(image.size, (settings.EMAIL_IMAGE_MAX_SIZE, settings.EMAIL_IMAGE_MAX_SIZE // 2))
+
+    def test_other_attachments_are_kept_as_is(self):
+        upload = SimpleUploadedFile('notes.txt', b'not an image', 'text/plain')
+        self.assertEqual(prepare_email_image(upload), ('notes.txt', upload, 'text/plain'))
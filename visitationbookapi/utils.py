@@ -1,117 +1,944 @@
 import os
 import re
+import time
+import logging
+import uuid
+import hashlib
+import pathlib
+import shutil
+import threading
+import tempfile
 from io import BytesIO
-from functools import wraps
+from functools import wraps, lru_cache
+from concurrent import futures
+from contextlib import contextmanager
+from urllib.parse import urlencode
 from visitationbook import settings
 from visitationbookapi.models import *
 from rest_framework.views import exception_handler
 from rest_framework.response import Response
+from django.core import signing
+from django.core.cache import cache
+from django.core.files import File
 from django.core.files.base import ContentFile
-from django.core.mail import EmailMultiAlternatives
+from django.core.files.uploadedfile import TemporaryUploadedFile
 from django.contrib.staticfiles.storage import staticfiles_storage
+from django.db import transaction, connection as db_connection
 from django.db.models import QuerySet
-from django.template.loader import render_to_string
-import tempfile
-from weasyprint import HTML
+from django.db.models.fields.files import FieldFile
+from django.template.loader import render_to_string, get_template
+from django.urls import reverse
+from django.utils import timezone
+from pypdf import PdfReader, PdfWriter
+from PIL import Image
+import pypdfium2 as pdfium
+from visitationbookapi import render_pool
 
+logger = logging.getLogger('visitationbookapi')
 
-def generate_pdf(book_purchase):
-    """Génère le PDF principal du book purchase avec WeasyPrint."""
-    try:
+# PDFium n'est pas thread-safe : un seul accès à la fois par processus
+_pdfium_lock = threading.Lock()
+
+# Nombre de visiteurs par page du visitation book
+PDF_CARDS_PER_PAGE = 4
+
+# Étapes chronométrées de chaque opération du pipeline PDF, exposées en métriques
+PDF_METRIC_STAGES = {
+    'visitation_book': ('images', 'query', 'template', 'layout', 'merge'),
+    'thank_you_note': ('images', 'background', 'template', 'layout', 'merge'),
+    'update_pdf': ('fingerprint', 'render', 'storage'),
+}
+PDF_METRIC_STATUSES = ('success', 'skipped', 'error')
+
+# Index de la page de la note dans le PDF de note de remerciement (après la couverture)
+THANK_YOU_NOTE_PAGE = 1
+
+# Objet de l'email de remerciement envoyé aux guests
+THANK_YOU_EMAIL_SUBJECT = "Thank you for your condolences"
+
+# Sel des liens signés vers le PDF de remerciement d'un guest
+THANK_YOU_PDF_SALT = 'visitationbookapi.thank_you_pdf'
+
+# Profils de rendu du visitation book : 'print' (qualité impression, rendu à la demande)
+# et 'web' (aperçu léger pour mobile, re-rendu à chaque modification)
+PDF_PROFILES = {
+    'print': {
+        'stylesheets': ('visitation_book',),
+        'image_dpi_setting': 'PDF_IMAGE_DPI',
+        'jpeg_quality': 85,
+        'file_field': 'pdf_file',
+        'fingerprint_field': 'pdf_fingerprint',
+        'volumes_field': 'pdf_volumes',
+        'segment_prefix': '',
+    },
+    'web': {
+        'stylesheets': ('visitation_book', 'visitation_book_web'),
+        'image_dpi_setting': 'PDF_WEB_IMAGE_DPI',
+        'jpeg_quality': 70,
+        'file_field': 'web_pdf_file',
+        'fingerprint_field': 'web_pdf_fingerprint',
+        'volumes_field': 'web_pdf_volumes',
+        'segment_prefix': 'web_',
+    },
+}
+
+# Emplacements des images dans les templates PDF : (largeur en pouces, hauteur en pouces, recadrage)
+PDF_IMAGE_SLOTS = {
+    'cover': (8.5, 11, True),      # fond de la première page (letter, background-size: cover)
+    'portrait': (6, 6, False),     # .deceased-image (max-width/max-height: 6in)
+    'guest': (1.2, 1.2, True),     # .visitor-image (object-fit: cover)
+}
+
+
+def generate_pdf(book_purchase, target=None, profile='print', volume=None, used_segments=None):
+    """
+    Génère le PDF principal du book purchase avec WeasyPrint.
+
+    Le livre est découpé en segments (couverture, chaque page de visiteurs, page de fin)
+    rendus séparément puis fusionnés. Chaque segment est mis en cache selon l'empreinte
+    de son contenu : l'ajout d'un visiteur ne re-rend que la dernière page de visiteurs.
+
+    Comme write_pdf() de WeasyPrint : si target (chemin ou fichier) est fourni, le PDF y
+    est écrit directement et None est renvoyé ; sinon ses octets sont renvoyés.
+    profile choisit le profil de rendu (voir PDF_PROFILES).
+
+    Au-delà de PDF_VOLUME_MAX_GUESTS visiteurs, le livre est découpé en volumes (voir
+    get_pdf_volume_count) : volume (à partir de 1) ne rend que les visiteurs de ce volume,
+    avec sa propre couverture et sa page de fin. Sans volume, le livre entier est rendu.
+    Les segments d'un volume ne sont pas nettoyés du cache : leurs noms sont ajoutés à
+    used_segments (ensemble), pour un nettoyage une fois tous les volumes rendus.
+    """
+    with PdfRenderStats('visitation_book', book_purchase=str(book_purchase.id), profile=profile, volume=volume) as stats:
         # Vérifier les fichiers nécessaires
         if book_purchase.deceased_image and not os.path.exists(book_purchase.deceased_image.path):
             raise FileNotFoundError(f"Deceased image file not found: {book_purchase.deceased_image.path}")
 
-        # Préparer les chemins des images
-        background_image = book_purchase.custom_cover.path if book_purchase.custom_cover else book_purchase.book.cover.path
-        deceased_image = book_purchase.deceased_image.path if book_purchase.deceased_image else None
+        # Préparer les images, réduites à la taille de leur emplacement dans le template
+        with stats.stage('images'):
+            background_image = get_pdf_image(book_purchase.custom_cover or book_purchase.book.cover, 'cover', profile)
+            deceased_image = get_pdf_image(book_purchase.deceased_image, 'portrait', profile)
         logo_path = os.path.join(settings.BASE_DIR, 'static', 'images', 'logo.png')
 
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            # Copier les images dans le répertoire temporaire
-            import shutil
-            tmp_bg = os.path.join(tmpdirname, 'background.jpg')
-            tmp_deceased = os.path.join(tmpdirname, 'deceased.jpg') if deceased_image else None
-            tmp_logo = os.path.join(tmpdirname, 'logo.png')
-            
-            shutil.copy2(background_image, tmp_bg)
-            if deceased_image:
-                shutil.copy2(deceased_image, tmp_deceased)
-            if os.path.exists(logo_path):
-                shutil.copy2(logo_path, tmp_logo)
-
-            # Préparer les données des visiteurs
-            guest_cards = []
-            for guest in book_purchase.guest_infos.all():
-                guest_data = {
-                    'name': guest.guest_name if book_purchase.allow_name else None,
-                    'address': guest.guest_address if book_purchase.allow_address else None,
-                    'email': guest.guest_email if book_purchase.allow_email else None,
-                    'notes': guest.special_notes if book_purchase.allow_special_notes else None
-                }
+        base_context = {
+            'deceased_name': book_purchase.deceased_name,
+            'date_of_birth': book_purchase.date_of_birth.strftime('%B %d, %Y') if book_purchase.date_of_birth else None,
+            'date_of_death': book_purchase.date_of_death.strftime('%B %d, %Y') if book_purchase.date_of_death else None,
+        }
 
-                if book_purchase.allow_picture and guest.guest_picture:
-                    guest_image_path = os.path.join(tmpdirname, f'guest_{guest.id}.jpg')
-                    shutil.copy2(guest.guest_picture.path, guest_image_path)
-                    guest_data['image'] = guest_image_path
-
-                guest_cards.append(guest_data)
-                
-            # Préparer les pages de visiteurs (4 visiteurs par page)
-            visitor_pages = []
-            cards_per_page = 4
-            for i in range(0, len(guest_cards), cards_per_page):
-                visitor_pages.append(guest_cards[i:i + cards_per_page])
-
-            # Contexte pour le template
-            context = {
-                'deceased_name': book_purchase.deceased_name,
-                'deceased_image': tmp_deceased,
-                'date_of_birth': book_purchase.date_of_birth.strftime('%B %d, %Y') if book_purchase.date_of_birth else None,
-                'date_of_death': book_purchase.date_of_death.strftime('%B %d, %Y') if book_purchase.date_of_death else None,
-                'background_image': tmp_bg,
-                'logo': tmp_logo,
-                'visitor_pages': visitor_pages  # Pages déjà préparées
+        # Préparer les données des visiteurs, dans l'ordre d'arrivée pour que
+        # les pages déjà remplies restent identiques d'un rendu à l'autre
+        with stats.stage('query'):
+            guests = book_purchase.guest_infos.order_by('created_at', 'id')
+            if volume is None:
+                volume_count = 1
+            else:
+                # Ne charger que les visiteurs du volume
+                volume_size = get_pdf_volume_size()
+                volume_count = get_pdf_volume_count(guests.count())
+                guests = guests[(volume - 1) * volume_size:volume * volume_size]
+            guests = list(guests)
+
+        # Segments : (nom, contexte du template, fichiers référencés)
+        segments = [
+            ('cover', {
+                **base_context,
+                'deceased_image': asset_uri(deceased_image),
+                'background_image': asset_uri(background_image),
+                'volume': volume,
+                'volume_count': volume_count,
+            }, [background_image, deceased_image])
+        ]
+
+        guest_cards = []
+        for guest in guests:
+            guest_data = {
+                'name': guest.guest_name if book_purchase.allow_name else None,
+                'address': guest.guest_address if book_purchase.allow_address else None,
+                'email': guest.guest_email if book_purchase.allow_email else None,
+                'notes': guest.special_notes if book_purchase.allow_special_notes else None
             }
 
-            # Générer le HTML
-            html_string = render_to_string('pdf/visitation_book.html', context)
-            html_path = os.path.join(tmpdirname, 'output.html')
-            
-            with open(html_path, 'w', encoding='utf-8') as f:
-                f.write(html_string)
+            if book_purchase.allow_picture and guest.guest_picture:
+                with stats.stage('images'):
+                    guest_data['image_path'] = get_pdf_image(guest.guest_picture, 'guest', profile)
+                guest_data['image'] = asset_uri(guest_data['image_path'])
+
+            guest_cards.append(guest_data)
+
+        # Préparer les pages de visiteurs (4 visiteurs par page), un segment par page
+        for i in range(0, len(guest_cards), PDF_CARDS_PER_PAGE):
+            page_guests = guest_cards[i:i + PDF_CARDS_PER_PAGE]
+            segments.append((
+                'visitors',
+                {**base_context, 'visitor_pages': [page_guests]},
+                [guest.get('image_path') for guest in page_guests]
+            ))
+
+        segments.append(('footer', {**base_context, 'logo': asset_uri(logo_path)}, [logo_path]))
+
+        cache_dir = os.path.join(settings.PDF_SEGMENT_CACHE_DIR, str(book_purchase.id))
+        os.makedirs(cache_dir, exist_ok=True)
+
+        segment_paths = render_pdf_segments(cache_dir, segments, stats, profile)
+
+        with stats.stage('merge'):
+            writer = PdfWriter()
+            for segment_path in segment_paths:
+                writer.append(segment_path)
+
+            # Supprimer les segments du profil qui ne font plus partie du livre
+            segment_names = {os.path.basename(segment_path) for segment_path in segment_paths}
+            if volume is None:
+                prune_pdf_segments(cache_dir, profile, segment_names)
+            elif used_segments is not None:
+                used_segments.update(segment_names)
 
             try:
-                # Générer le PDF
-                pdf_buffer = BytesIO()
-                HTML(filename=html_path, base_url=tmpdirname).write_pdf(
-                    pdf_buffer,
-                    presentational_hints=True,
-                    optimize_size=('fonts', 'images')
-                )
-
-                pdf = pdf_buffer.getvalue()
+                if target is None:
+                    with BytesIO() as pdf_buffer:
+                        writer.write(pdf_buffer)
+                        pdf = pdf_buffer.getvalue()
+                    stats.output_bytes = len(pdf)
+                else:
+                    writer.write(target)
+                    pdf = None
+                    stats.output_bytes = os.path.getsize(target) if isinstance(target, (str, os.PathLike)) else target.tell()
+                stats.pages = len(writer.pages)
             finally:
-                if os.path.exists(html_path):
-                    os.unlink(html_path)
-                pdf_buffer.close()
-                
-            return pdf
-
-    except Exception as e:
-        print(f"Error generating PDF: {e}")
+                writer.close()
+
+        stats.fields['guests'] = len(guests)
+        return pdf
+
+
+def prune_pdf_segments(cache_dir, profile, used_segments):
+    """Supprime du cache les segments du profil absents de used_segments (noms de fichiers)"""
+    prefix = PDF_PROFILES[profile]['segment_prefix']
+    for filename in os.listdir(cache_dir):
+        if filename.startswith((f'{prefix}cover_', f'{prefix}visitors_', f'{prefix}footer_')) and filename not in used_segments and not filename.endswith('.tmp'):
+            os.unlink(os.path.join(cache_dir, filename))
+
+
+def get_pdf_volume_size():
+    """Nombre maximal de visiteurs par volume, arrondi à une page de visiteurs pleine (0 : pas de volumes)"""
+    if not settings.PDF_VOLUME_MAX_GUESTS:
+        return 0
+    return max(settings.PDF_VOLUME_MAX_GUESTS // PDF_CARDS_PER_PAGE, 1) * PDF_CARDS_PER_PAGE
+
+
+def get_pdf_volume_count(guest_count):
+    """Nombre de volumes d'un livre de guest_count visiteurs"""
+    volume_size = get_pdf_volume_size()
+    if not volume_size or guest_count <= volume_size:
+        return 1
+    return -(-guest_count // volume_size)
+
+
+def get_pdf_volume_name(name, volume):
+    """Nom du fichier d'un volume, dérivé de celui du premier volume (stocké dans le champ du profil)"""
+    if volume == 1:
+        return name
+    root, ext = os.path.splitext(name)
+    return f'{root}_vol{volume}{ext}'
+
+
+def get_pdf_volume_names(book_purchase, profile='print'):
+    """Noms des fichiers de tous les volumes du PDF du profil, dans l'ordre"""
+    config = PDF_PROFILES[profile]
+    name = getattr(book_purchase, config['file_field']).name
+    if not name:
+        return []
+    return [get_pdf_volume_name(name, volume) for volume in range(1, getattr(book_purchase, config['volumes_field']) + 1)]
+
+
+class PdfRenderStats:
+    """
+    Chronométrage par étape d'une opération du pipeline PDF.
+
+    À la sortie du bloc `with`, publie un log structuré (logger `visitationbookapi`,
+    champ `pdf_render` pour les formateurs JSON) et incrémente les métriques exposées
+    par PdfMetricsView. Les exceptions sont journalisées puis propagées.
+    """
+
+    def __init__(self, operation, **fields):
+        self.operation = operation
+        self.fields = fields
+        self.stages = {}
+        self.status = 'success'
+        self.pages = None
+        self.output_bytes = None
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.status = 'error'
+            self.fields['error'] = str(exc_value)
+
+        data = {
+            'operation': self.operation,
+            'status': self.status,
+            'duration': round(self.duration, 4),
+            'stages': {name: round(seconds, 4) for name, seconds in self.stages.items()},
+            'pages': self.pages,
+            'bytes': self.output_bytes,
+            **self.fields,
+        }
+        message = ' '.join(f'{key}={value}' for key, value in data.items() if value is not None and key != 'stages')
+        message += ''.join(f' stage_{name}={seconds}' for name, seconds in data['stages'].items())
+        logger.log(
+            logging.ERROR if exc_type is not None else logging.INFO,
+            "PDF render %s", message,
+            exc_info=exc_type is not None,
+            extra={'pdf_render': data},
+        )
+        record_pdf_metrics(self)
+        return False
+
+
+def record_pdf_metrics(stats):
+    """Incrémente les compteurs de métriques PDF (dans le cache, partagé entre processus)"""
+    amounts = {
+        ('renders', stats.operation, stats.status): 1,
+        ('duration_us', stats.operation, ''): round(stats.duration * 1e6),
+        ('bytes', stats.operation, ''): stats.output_bytes or 0,
+        ('pages', stats.operation, ''): stats.pages or 0,
+    }
+    for name, seconds in stats.stages.items():
+        amounts[('stage_us', stats.operation, name)] = round(seconds * 1e6)
+
+    try:
+        for (metric, operation, label), amount in amounts.items():
+            key = f'pdf_metrics:{metric}:{operation}:{label}'
+            cache.add(key, 0, timeout=None)
+            if amount:
+                cache.incr(key, amount)
+    except Exception:
+        # Les métriques ne doivent jamais faire échouer un rendu
+        logger.warning("Unable to record PDF metrics", exc_info=True)
+
+
+def render_pdf_metrics():
+    """Métriques du pipeline PDF au format texte Prometheus"""
+    keys = {}
+    for operation, stages in PDF_METRIC_STAGES.items():
+        for status in PDF_METRIC_STATUSES:
+            keys[f'pdf_metrics:renders:{operation}:{status}'] = ('renders', operation, status)
+        for metric in ('duration_us', 'bytes', 'pages'):
+            keys[f'pdf_metrics:{metric}:{operation}:'] = (metric, operation, '')
+        for stage in stages:
+            keys[f'pdf_metrics:stage_us:{operation}:{stage}'] = ('stage_us', operation, stage)
+    values = cache.get_many(list(keys))
+
+    def value(metric, operation, label=''):
+        return values.get(f'pdf_metrics:{metric}:{operation}:{label}', 0)
+
+    lines = [
+        '# HELP visitationbook_pdf_renders_total PDF pipeline operations by status.',
+        '# TYPE visitationbook_pdf_renders_total counter',
+    ]
+    for operation in PDF_METRIC_STAGES:
+        for status in PDF_METRIC_STATUSES:
+            lines.append(f'visitationbook_pdf_renders_total{{operation="{operation}",status="{status}"}} {value("renders", operation, status)}')
+
+    lines += [
+        '# HELP visitationbook_pdf_render_seconds Duration of the PDF pipeline operations.',
+        '# TYPE visitationbook_pdf_render_seconds summary',
+    ]
+    for operation in PDF_METRIC_STAGES:
+        count = sum(value('renders', operation, status) for status in PDF_METRIC_STATUSES)
+        lines.append(f'visitationbook_pdf_render_seconds_sum{{operation="{operation}"}} {value("duration_us", operation) / 1e6}')
+        lines.append(f'visitationbook_pdf_render_seconds_count{{operation="{operation}"}} {count}')
+
+    lines += [
+        '# HELP visitationbook_pdf_stage_seconds_total Time spent in each stage of the PDF pipeline.',
+        '# TYPE visitationbook_pdf_stage_seconds_total counter',
+    ]
+    for operation, stages in PDF_METRIC_STAGES.items():
+        for stage in stages:
+            lines.append(f'visitationbook_pdf_stage_seconds_total{{operation="{operation}",stage="{stage}"}} {value("stage_us", operation, stage) / 1e6}')
+
+    lines += [
+        '# HELP visitationbook_pdf_output_bytes_total Bytes of PDF produced.',
+        '# TYPE visitationbook_pdf_output_bytes_total counter',
+    ]
+    for operation in PDF_METRIC_STAGES:
+        lines.append(f'visitationbook_pdf_output_bytes_total{{operation="{operation}"}} {value("bytes", operation)}')
+
+    lines += [
+        '# HELP visitationbook_pdf_pages_total Pages of PDF produced.',
+        '# TYPE visitationbook_pdf_pages_total counter',
+    ]
+    for operation in PDF_METRIC_STAGES:
+        lines.append(f'visitationbook_pdf_pages_total{{operation="{operation}"}} {value("pages", operation)}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def asset_uri(path):
+    """URI file:// d'une image à référencer en place dans un template PDF"""
+    if not path or not os.path.exists(path):
+        return None
+    return pathlib.Path(path).resolve().as_uri()
+
+
+def render_pdf_segments(cache_dir, segments, stats, profile='print'):
+    """
+    Rend en parallèle (pool de rendu) les segments du visitation book absents du cache
+    et renvoie leurs chemins dans l'ordre.
+    La clé de cache couvre le HTML du segment, la version du template et du profil et
+    l'état (taille, date) des fichiers qu'il référence ; un segment inchangé n'est jamais
+    re-rendu.
+    """
+    config = PDF_PROFILES[profile]
+    segment_paths = []
+    pending = {}
+    for segment, context, assets in segments:
+        with stats.stage('template'):
+            html_string = render_to_string('pdf/visitation_book.html', {**context, 'segment': segment})
+
+        digest = hashlib.sha256(html_string.encode('utf-8'))
+        digest.update(get_pdf_profile_version(profile).encode('utf-8'))
+        for asset in assets:
+            digest.update(file_signature(asset).encode('utf-8'))
+
+        segment_path = os.path.join(cache_dir, f"{config['segment_prefix']}{segment}_{digest.hexdigest()}.pdf")
+        segment_paths.append(segment_path)
+        if segment_path in pending or os.path.exists(segment_path):
+            continue
+
+        # Écrire dans un fichier temporaire puis renommer : un segment en cache est toujours complet
+        tmp_path = f'{segment_path}.{uuid.uuid4().hex}.tmp'
+        pending[segment_path] = (tmp_path, submit_pdf_render(html_string, config['stylesheets'], tmp_path))
+
+    try:
+        with stats.stage('layout'):
+            futures.wait([future for _, future in pending.values()])
+        for segment_path, (tmp_path, future) in pending.items():
+            future.result()
+            os.replace(tmp_path, segment_path)
+    finally:
+        for tmp_path, _ in pending.values():
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    stats.fields['segments'] = len(segment_paths)
+    stats.fields['segments_rendered'] = len(pending)
+    return segment_paths
+
+
+def submit_pdf_render(html_string, stylesheets, target=None, optimize_size=('fonts',)):
+    """
+    Soumet un rendu WeasyPrint au pool de rendu (démarré au premier appel).
+    stylesheets désigne une ou plusieurs feuilles de style partagées pdf/<nom>.css.
+    """
+    if isinstance(stylesheets, str):
+        stylesheets = (stylesheets,)
+    configure_render_pool()
+    return render_pool.submit(html_string, settings.MEDIA_ROOT, tuple(stylesheets), target, optimize_size)
+
+
+def configure_render_pool():
+    """Démarre le pool de rendu s'il ne l'est pas déjà"""
+    render_pool.configure(
+        settings.PDF_RENDER_POOL_SIZE,
+        get_pdf_stylesheets(),
+        [settings.MEDIA_ROOT, settings.STATIC_ROOT],
+        memory_limit=settings.PDF_RENDER_MEMORY_LIMIT * 1024 ** 2,
+        cpu_limit=settings.PDF_RENDER_CPU_LIMIT,
+        url_roots=[
+            (f'{settings.BASE_URL}{settings.MEDIA_URL}', settings.MEDIA_ROOT),
+            (f'{settings.BASE_URL}{settings.STATIC_URL}', settings.STATIC_ROOT),
+        ],
+    )
+
+
+@lru_cache(maxsize=None)
+def get_pdf_stylesheets():
+    """Chemins des feuilles de style partagées des templates PDF, pré-analysées par le pool"""
+    return {
+        name: get_template(f'pdf/{name}.css').origin.name
+        for name in ('visitation_book', 'visitation_book_web', 'thank_you_note')
+    }
+
+
+def get_pdf_image(image_field, slot, profile='print'):
+    """
+    Chemin d'un dérivé JPEG de l'image, dimensionné pour son emplacement dans les templates
+    PDF (à la résolution du profil de rendu) et avec l'orientation EXIF appliquée.
+
+    Le dérivé est produit une seule fois par upload, sous un chemin déterministe de
+    PDF_IMAGE_CACHE_DIR ; en cas d'échec on retombe sur l'image d'origine. L'image est
+    décodée dans le pool de rendu, borné en mémoire et en temps CPU.
+    """
+    if not image_field:
+        return None
+
+    source_path = image_field.path
+    derivative_path = get_pdf_image_path(image_field.name, slot, profile)
+    try:
+        if os.path.getmtime(derivative_path) >= os.path.getmtime(source_path):
+            return derivative_path
+    except OSError:
+        pass
+
+    if not os.path.exists(source_path):
+        return None
+
+    crop = PDF_IMAGE_SLOTS[slot][2]
+    size = get_pdf_image_size(slot, profile)
+    tmp_path = f'{derivative_path}.{uuid.uuid4().hex}.tmp'
+    try:
+        os.makedirs(os.path.dirname(derivative_path), exist_ok=True)
+        configure_render_pool()
+        render_pool.submit_image(source_path, tmp_path, size, crop, PDF_PROFILES[profile]['jpeg_quality']).result()
+        os.replace(tmp_path, derivative_path)
+        return derivative_path
+    except (Image.DecompressionBombError, render_pool.RenderLimitExceeded):
+        # Image démesurée : ne pas la confier telle quelle au rendu
         raise
+    except Exception:
+        logger.exception("Error creating PDF image for %s", image_field.name)
+        return source_path
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
 
 
-def update_pdf(book_purchase):
-    book_purchase.delete_existing_pdf()
-    pdf = generate_pdf(book_purchase)
-    book_purchase.pdf_file.save(f'book_purchase_{book_purchase.id}.pdf', ContentFile(pdf), save=True)
-    
+def get_pdf_image_size(slot, profile='print'):
+    """Taille en pixels d'un emplacement d'image à la résolution du profil"""
+    width_in, height_in, _ = PDF_IMAGE_SLOTS[slot]
+    dpi = getattr(settings, PDF_PROFILES[profile]['image_dpi_setting'])
+    return round(width_in * dpi), round(height_in * dpi)
+
+
+def get_pdf_image_path(name, slot, profile='print'):
+    """
+    Chemin déterministe du dérivé PDF d'un fichier uploadé. La taille et la qualité JPEG
+    en font partie : changer la résolution d'un profil produit de nouveaux dérivés.
+    """
+    width, height = get_pdf_image_size(slot, profile)
+    directory = f"{slot}_{width}x{height}_q{PDF_PROFILES[profile]['jpeg_quality']}"
+    return os.path.join(settings.PDF_IMAGE_CACHE_DIR, directory, f'{os.path.splitext(name)[0]}.jpg')
+
+
+def delete_pdf_images(image_field):
+    """Supprime les dérivés PDF d'une image, pour tous les profils"""
+    if not image_field:
+        return
+    for slot in PDF_IMAGE_SLOTS:
+        for profile in PDF_PROFILES:
+            path = get_pdf_image_path(image_field.name, slot, profile)
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+def file_signature(path):
+    """Identité peu coûteuse d'un fichier (chemin, taille, date de modification)"""
+    if not path or not os.path.exists(path):
+        return ''
+    stat = os.stat(path)
+    return f'{path}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+@lru_cache(maxsize=None)
+def get_pdf_template_version(template_name='pdf/visitation_book.html'):
+    """Version du template PDF : PDF_TEMPLATE_VERSION et empreinte de sa source et de sa feuille de style"""
+    source = get_template(template_name).template.source
+    source += get_template(f'{os.path.splitext(template_name)[0]}.css').template.source
+    return f"{settings.PDF_TEMPLATE_VERSION}:{hashlib.sha256(source.encode('utf-8')).hexdigest()}"
+
+
+@lru_cache(maxsize=None)
+def get_pdf_profile_version(profile):
+    """
+    Version d'un profil de rendu : version du template et de ses feuilles de style
+    additionnelles, résolution et qualité JPEG des images
+    """
+    config = PDF_PROFILES[profile]
+    version = f"{get_pdf_template_version()}:{getattr(settings, config['image_dpi_setting'])}dpi:q{config['jpeg_quality']}"
+    extra_stylesheets = config['stylesheets'][1:]
+    if extra_stylesheets:
+        source = ''.join(get_template(f'pdf/{name}.css').template.source for name in extra_stylesheets)
+        version += f":{profile}:{hashlib.sha256(source.encode('utf-8')).hexdigest()}"
+    return version
+
+
+def compute_pdf_fingerprint(book_purchase, profile='print'):
+    """
+    Empreinte déterministe de tout ce que consomme generate_pdf() : infos du défunt,
+    options allow_*, images (couverture, défunt, logo), lignes des visiteurs et version
+    du template et du profil. Deux livres de même empreinte produisent le même PDF.
+    """
+    cover = book_purchase.custom_cover if book_purchase.custom_cover else book_purchase.book.cover
+    parts = [
+        get_pdf_profile_version(profile),
+        str(get_pdf_volume_size()),
+        book_purchase.deceased_name or '',
+        str(book_purchase.date_of_birth or ''),
+        str(book_purchase.date_of_death or ''),
+        file_signature(cover.path if cover else None),
+        file_signature(book_purchase.deceased_image.path if book_purchase.deceased_image else None),
+        file_signature(os.path.join(settings.BASE_DIR, 'static', 'images', 'logo.png')),
+    ]
+
+    digest = hashlib.sha256('\n'.join(parts).encode('utf-8'))
+
+    # Parcourir les visiteurs par lots : la mémoire reste bornée quelle que soit la taille du livre
+    guests = book_purchase.guest_infos.order_by('created_at', 'id').values_list(
+        'id', 'guest_name', 'guest_address', 'guest_email', 'special_notes', 'guest_picture'
+    )
+    for guest_id, name, address, email, notes, picture in guests.iterator(chunk_size=2000):
+        digest.update(('\n' + '|'.join([
+            str(guest_id),
+            (name or '') if book_purchase.allow_name else '',
+            (address or '') if book_purchase.allow_address else '',
+            (email or '') if book_purchase.allow_email else '',
+            (notes or '') if book_purchase.allow_special_notes else '',
+            file_signature(os.path.join(settings.MEDIA_ROOT, picture)) if book_purchase.allow_picture and picture else '',
+        ])).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def update_pdf(book_purchase, profile='print'):
+    """
+    Rend le PDF du profil donné et l'enregistre dans son champ (pdf_file pour print,
+    web_pdf_file pour web), sauf si rien de visible n'a changé depuis le dernier rendu.
+    Un livre découpé en volumes est rendu volume par volume ; le champ désigne le premier,
+    les suivants sont nommés d'après lui (voir get_pdf_volume_names).
+    À appeler sous pdf_render_lock.
+    """
+    config = PDF_PROFILES[profile]
+    # L'instance a pu être chargée avant le verrou : un autre rendu a peut-être déjà basculé
+    # vers de nouveaux fichiers, relire l'état du PDF pour ne pas supprimer ce qu'il a écrit
+    book_purchase.refresh_from_db(fields=[config['file_field'], config['volumes_field'], config['fingerprint_field'], 'pdf_stale', 'pdf_error'])
+    with PdfRenderStats('update_pdf', book_purchase=str(book_purchase.id), profile=profile) as stats:
+        # Acquitter l'obsolescence avant le rendu : une écriture concurrente la remettra à True
+        # (pdf_stale concerne le PDF d'impression, rendu à la demande)
+        if profile == 'print':
+            type(book_purchase).objects.filter(pk=book_purchase.pk).update(pdf_stale=False)
+            book_purchase.pdf_stale = False
+        field_file = getattr(book_purchase, config['file_field'])
+        old_names = get_pdf_volume_names(book_purchase, profile)
+        new_names = []
+        try:
+            # Rien de visible n'a changé depuis le dernier rendu : garder le PDF existant
+            with stats.stage('fingerprint'):
+                fingerprint = compute_pdf_fingerprint(book_purchase, profile)
+            if field_file and getattr(book_purchase, config['fingerprint_field']) == fingerprint and os.path.isfile(field_file.path):
+                stats.status = 'skipped'
+                return False
+
+            # Nom neuf à chaque rendu : l'ancien PDF reste servi jusqu'au basculement
+            volume_count = get_pdf_volume_count(book_purchase.guest_infos.count())
+            suffix = '' if profile == 'print' else f'_{profile}'
+            name = field_file.field.generate_filename(book_purchase, f'book_purchase_{book_purchase.id}{suffix}_{uuid.uuid4().hex[:12]}.pdf')
+            used_segments = set()
+            stats.output_bytes = 0
+            for volume in range(1, volume_count + 1):
+                # Chaque volume est écrit dans un fichier temporaire que le stockage déplace
+                # ensuite en place : il n'est jamais chargé en mémoire en entier
+                volume_name = get_pdf_volume_name(new_names[0] if new_names else name, volume)
+                pdf_file = TemporaryUploadedFile(os.path.basename(volume_name), 'application/pdf', 0, None)
+                try:
+                    with stats.stage('render'):
+                        generate_pdf(book_purchase, pdf_file, profile, volume if volume_count > 1 else None, used_segments)
+                    with stats.stage('storage'):
+                        pdf_file.size = pdf_file.tell()
+                        stats.output_bytes += pdf_file.size
+                        pdf_file.seek(0)
+                        new_names.append(field_file.storage.save(volume_name, pdf_file))
+                finally:
+                    pdf_file.close()
+
+            if volume_count > 1:
+                prune_pdf_segments(os.path.join(settings.PDF_SEGMENT_CACHE_DIR, str(book_purchase.id)), profile, used_segments)
+        except Exception as e:
+            # Ne pas laisser de volumes orphelins
+            for new_name in new_names:
+                field_file.storage.delete(new_name)
+            if profile == 'print':
+                type(book_purchase).objects.filter(pk=book_purchase.pk).update(pdf_stale=True)
+                book_purchase.pdf_stale = True
+            record_pdf_error(book_purchase, profile, e)
+            raise
+
+        with stats.stage('storage'):
+            field_file.name = new_names[0]
+            setattr(book_purchase, config['volumes_field'], volume_count)
+            setattr(book_purchase, config['fingerprint_field'], fingerprint)
+
+            # Basculer vers les nouveaux fichiers par un UPDATE ciblé (sans la logique PDF de save()),
+            # puis seulement supprimer les anciens : le PDF reste téléchargeable pendant le rendu
+            type(book_purchase).objects.filter(pk=book_purchase.pk).update(**{
+                config['file_field']: field_file.name,
+                config['volumes_field']: volume_count,
+                config['fingerprint_field']: fingerprint,
+            })
+            for old_name in old_names:
+                if old_name not in new_names:
+                    field_file.storage.delete(old_name)
+        record_pdf_error(book_purchase, profile)
+        return True
+
+
+def record_pdf_error(book_purchase, operation, error=None):
+    """
+    Enregistre sur le livre (pdf_error) l'échec du dernier rendu de operation ('print',
+    'web', 'thank_you_note'), ou l'efface après un rendu réussi (error=None).
+    """
+    prefix = f'{operation}: '
+    if error is None:
+        # Pas d'écriture si aucun échec de cette opération n'est enregistré
+        if (book_purchase.pdf_error or '').startswith(prefix):
+            type(book_purchase).objects.filter(pk=book_purchase.pk, pdf_error__startswith=prefix).update(pdf_error=None)
+            book_purchase.pdf_error = None
+        return
+    book_purchase.pdf_error = f'{prefix}{error}'
+    type(book_purchase).objects.filter(pk=book_purchase.pk).update(pdf_error=book_purchase.pdf_error)
+
+
+@contextmanager
+def pdf_render_lock(book_purchase):
+    """
+    Verrou (via le cache) empêchant deux rendus simultanés du même livre.
+    Si un rendu est déjà en cours, attend sa fin avant de rendre la main.
+    """
+    lock_key = get_pdf_render_lock_key(book_purchase)
+    deadline = time.monotonic() + settings.PDF_RENDER_JOB_TIMEOUT
+    while not cache.add(lock_key, True, settings.PDF_RENDER_JOB_TIMEOUT):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"PDF render lock for book_purchase {book_purchase.pk} not released")
+        time.sleep(0.5)
+    try:
+        yield
+    finally:
+        cache.delete(lock_key)
+
+
+def get_pdf_render_lock_key(book_purchase):
+    return f'book_purchase_pdf_lock_{book_purchase.pk}'
+
+
+def is_pdf_render_locked(book_purchase):
+    """Vrai si un rendu du livre est en cours (sans attendre sa fin)"""
+    return cache.get(get_pdf_render_lock_key(book_purchase)) is not None
+
+
+def count_pdf_pages(path):
+    """Nombre de pages d'un PDF"""
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+
+
+def get_pdf_previews(book_purchase, pages, page_counts):
+    """
+    Vignettes des pages demandées (numérotées à partir de 1, volumes mis bout à bout) du
+    PDF web du livre ; page_counts donne le nombre de pages de chaque volume.
+    Rastérisées à la première demande puis servies depuis un cache propre à l'empreinte
+    du PDF : une vignette n'est jamais recalculée tant que le livre ne change pas.
+    """
+    fingerprint = book_purchase.web_pdf_fingerprint
+    book_dir = os.path.join(settings.PDF_PREVIEW_CACHE_DIR, str(book_purchase.id))
+    preview_dir = os.path.join(book_dir, fingerprint)
+    extension = settings.PDF_PREVIEW_FORMAT.lower()
+    paths = {page: os.path.join(preview_dir, f'page_{page}.{extension}') for page in pages}
+
+    # Volume et index (à partir de 0) dans le volume de chaque page
+    locations = {}
+    for page in pages:
+        index = page - 1
+        for volume, page_count in enumerate(page_counts):
+            if index < page_count:
+                locations[page] = (volume, index, page_count)
+                break
+            index -= page_count
+
+    missing = [page for page, path in paths.items() if not os.path.exists(path)]
+    if missing:
+        os.makedirs(preview_dir, exist_ok=True)
+        volume_names = get_pdf_volume_names(book_purchase, 'web')
+        storage = book_purchase.web_pdf_file.storage
+        with _pdfium_lock:
+            for volume in sorted({locations[page][0] for page in missing}):
+                pdf = pdfium.PdfDocument(storage.path(volume_names[volume]))
+                try:
+                    for page_number in missing:
+                        if locations[page_number][0] != volume:
+                            continue
+                        page = pdf[locations[page_number][1]]
+                        bitmap = page.render(scale=settings.PDF_PREVIEW_WIDTH / page.get_width())
+                        tmp_path = f'{paths[page_number]}.{uuid.uuid4().hex}.tmp'
+                        bitmap.to_pil().save(tmp_path, settings.PDF_PREVIEW_FORMAT, quality=80)
+                        os.replace(tmp_path, paths[page_number])
+                finally:
+                    pdf.close()
+
+        # Supprimer les vignettes des versions précédentes du livre
+        for name in os.listdir(book_dir):
+            if name != fingerprint:
+                shutil.rmtree(os.path.join(book_dir, name), ignore_errors=True)
+
+    previews = []
+    for page, path in paths.items():
+        with Image.open(path) as image:
+            width, height = image.size
+        volume, index, page_count = locations[page]
+        if index == 0:
+            kind = 'cover'
+        elif index == page_count - 1:
+            kind = 'footer'
+        else:
+            kind = 'visitors'
+        previews.append({
+            'page': page,
+            'volume': volume + 1,
+            'kind': kind,
+            'url': get_full_url(settings.MEDIA_URL + pathlib.Path(os.path.relpath(path, settings.MEDIA_ROOT)).as_posix()),
+            'width': width,
+            'height': height,
+        })
+    return previews
+
+
+@lru_cache(maxsize=None)
+def get_email_static_context():
+    """Contexte commun à tous les emails : l'URL du logo (lookup dans le manifeste des statiques) n'est calculée qu'une fois"""
+    return {
+        'logo_url': f'{settings.BASE_URL}{staticfiles_storage.url("images/logo.png")}',
+        'front_url': settings.FRONT_URL,
+    }
+
+
+@lru_cache(maxsize=None)
+def get_email_templates(template_name):
+    """Templates compilés (.txt, .html) d'un email de templates/email/"""
+    return get_template(f'email/{template_name}.txt'), get_template(f'email/{template_name}.html')
+
+
+def render_email(template_name, context):
+    """Rend un email ; renvoie (texte brut, HTML)"""
+    return render_emails(template_name, [context])[0]
+
+
+def render_emails(template_name, contexts):
+    """Rend un même email pour plusieurs contextes (envoi en lot) ; renvoie une liste de (texte brut, HTML)"""
+    text_template, html_template = get_email_templates(template_name)
+    static_context = get_email_static_context()
+    rendered = []
+    for context in contexts:
+        context = {**static_context, **context}
+        rendered.append((text_template.render(context), html_template.render(context)))
+    return rendered
+
+
+class EmailMessageTooLarge(Exception):
+    """Un email dépasse EMAIL_MAX_MESSAGE_BYTES"""
+
+
+def prepare_email_image(uploaded_file):
+    """
+    Réduit une image jointe à un email (EMAIL_IMAGE_MAX_SIZE pixels de côté, JPEG) avec
+    l'orientation EXIF appliquée. L'image est décodée dans le pool de rendu, borné en mémoire
+    et en temps CPU, et le résultat écrit dans un fichier temporaire, stocké une fois dans
+    l'outbox quel que soit le nombre de destinataires. Renvoie (nom, fichier, type MIME) ;
+    une pièce jointe qui n'est pas une image lisible est renvoyée telle quelle.
+    """
+    max_size = settings.EMAIL_IMAGE_MAX_SIZE
+    output = tempfile.NamedTemporaryFile(suffix='.jpg')
+    source = None
+    try:
+        if hasattr(uploaded_file, 'temporary_file_path'):
+            source_path = uploaded_file.temporary_file_path()
+        else:
+            # Upload gardé en mémoire : le pool lit un fichier
+            source = tempfile.NamedTemporaryFile()
+            for chunk in uploaded_file.chunks():
+                source.write(chunk)
+            source.flush()
+            source_path = source.name
+        configure_render_pool()
+        render_pool.submit_image(source_path, output.name, (max_size, max_size), quality=settings.EMAIL_IMAGE_JPEG_QUALITY).result()
+    except (Image.DecompressionBombError, render_pool.RenderLimitExceeded):
+        output.close()
+        raise
+    except Exception:
+        output.close()
+        uploaded_file.seek(0)
+        return uploaded_file.name, uploaded_file, uploaded_file.content_type
+    finally:
+        if source is not None:
+            source.close()
+    output.seek(0)
+    name = f'{os.path.splitext(uploaded_file.name)[0]}.jpg'
+    return name, File(output, name=name), 'image/jpeg'
+
+
+def get_email_size(body, html_body=None, contents=()):
+    """Taille approximative (octets) d'un email : corps et pièces jointes encodées en base64"""
+    size = len(body.encode('utf-8')) + len((html_body or '').encode('utf-8'))
+    for content in contents:
+        length = content.size if isinstance(content, File) else len(content)
+        encoded = (length + 2) // 3 * 4
+        # Lignes base64 de 76 caractères
+        size += encoded + encoded // 76 * 2
+    return size
+
+
+def queue_email(subject, body, to, html_body=None, from_email=None, attachments=(), inline_images=(), kind=''):
+    """
+    Place un email dans l'outbox ; il est envoyé hors requête par `manage.py send_queued_emails`.
+    attachments : (nom, contenu, type MIME) ; inline_images : (content_id, nom, contenu, type MIME).
+    Un contenu est des octets, un fichier, ou un FieldFile déjà stocké (joint sans copie).
+    Lève EmailMessageTooLarge si l'email dépasse EMAIL_MAX_MESSAGE_BYTES.
+    """
+    # Import local : models importe ce module
+    from visitationbookapi.models import OutboxEmail, OutboxAttachment
+
+    parts = [(None, *attachment) for attachment in attachments] + list(inline_images)
+    size = get_email_size(body, html_body, [content for _, _, content, _ in parts])
+    if settings.EMAIL_MAX_MESSAGE_BYTES and size > settings.EMAIL_MAX_MESSAGE_BYTES:
+        # Le relais SMTP le refuserait à chaque nouvel essai
+        raise EmailMessageTooLarge(
+            f"Email too large: {size / 1024 ** 2:.1f} MB, the limit is {settings.EMAIL_MAX_MESSAGE_BYTES / 1024 ** 2:.1f} MB"
+        )
+
+    with transaction.atomic():
+        email = OutboxEmail.objects.create(
+            kind=kind,
+            subject=subject,
+            body=body,
+            html_body=html_body,
+            from_email=from_email,
+            to=list(to),
+        )
+        for content_id, filename, content, mimetype in parts:
+            attachment = OutboxAttachment(email=email, filename=filename, mimetype=mimetype or 'application/octet-stream', content_id=content_id)
+            if isinstance(content, FieldFile):
+                attachment.file.name = content.name
+                attachment.save()
+            else:
+                attachment.file.save(filename, content if isinstance(content, File) else ContentFile(content), save=True)
+    return email
+
 
 def send_welcome_email(user):
-    logo_url = f'{settings.BASE_URL}{staticfiles_storage.url("images/logo.png")}'
-    
     subject = "Welcome to Visitation Book"
     from_email = settings.DEFAULT_FROM_EMAIL
     to_email = user.email
@@ -120,24 +947,12 @@ def send_welcome_email(user):
     context = {
         'full_name': user.full_name,
         'login_url': settings.FRONT_URL,
-        'logo_url': logo_url
     }
 
     # Render email templates
-    email_html_message = render_to_string('email/welcome_email.html', context)
-    email_plaintext_message = render_to_string('email/welcome_email.txt', context)
+    email_plaintext_message, email_html_message = render_email('welcome_email', context)
 
-    try:
-        msg = EmailMultiAlternatives(
-            subject,
-            email_plaintext_message,
-            from_email,
-            [to_email]
-        )
-        msg.attach_alternative(email_html_message, "text/html")
-        msg.send()
-    except Exception as e:
-        print(e)
+    queue_email(subject, email_plaintext_message, [to_email], html_body=email_html_message, from_email=from_email, kind='welcome')
         
 
 def send_payment_confirmation_email(user, book_purchase):
@@ -145,8 +960,6 @@ def send_payment_confirmation_email(user, book_purchase):
     Send a payment confirmation email to the customer.
 
     """
-    logo_url = f'{settings.BASE_URL}{staticfiles_storage.url("images/logo.png")}'
-    
     subject = "Payment Confirmation"
     recipient_email = user.email
     from_email = settings.DEFAULT_FROM_EMAIL
@@ -162,31 +975,17 @@ def send_payment_confirmation_email(user, book_purchase):
         'amount': book_purchase.book.price,
         'book_title': book_purchase.book.title,
         'payment_status': "Completed",
-        'logo_url': logo_url,
     }
 
-    email_html_message = render_to_string('email/payment_confirmation.html', context)
-    email_plaintext_message = render_to_string('email/payment_confirmation.txt', context)
+    email_plaintext_message, email_html_message = render_email('payment_confirmation', context)
 
-    try:
-        email_message = EmailMultiAlternatives(
-            subject,
-            email_plaintext_message,
-            from_email,
-            [recipient_email]
-        )
-        email_message.attach_alternative(email_html_message, "text/html")
-        email_message.send()
-    except Exception as e:
-        print(e)
+    queue_email(subject, email_plaintext_message, [recipient_email], html_body=email_html_message, from_email=from_email, kind='payment_confirmation')
         
         
 def send_subscription_confirmation_email(user, subscription):
     """
     Send a subscription confirmation email to the customer.
     """
-    logo_url = f'{settings.BASE_URL}{staticfiles_storage.url("images/logo.png")}'
-    
     subject = "Subscription Confirmation"
     recipient_email = user.email
     from_email = settings.DEFAULT_FROM_EMAIL
@@ -202,23 +1001,11 @@ def send_subscription_confirmation_email(user, subscription):
         'amount': subscription.plan.price,
         'max_books': subscription.plan.max_books,
         'payment_status': "Completed",
-        'logo_url': logo_url,
     }
 
-    email_html_message = render_to_string('email/subscription_confirmation.html', context)
-    email_plaintext_message = render_to_string('email/subscription_confirmation.txt', context)
+    email_plaintext_message, email_html_message = render_email('subscription_confirmation', context)
 
-    try:
-        email_message = EmailMultiAlternatives(
-            subject,
-            email_plaintext_message,
-            from_email,
-            [recipient_email]
-        )
-        email_message.attach_alternative(email_html_message, "text/html")
-        email_message.send()
-    except Exception as e:
-        print(e)
+    queue_email(subject, email_plaintext_message, [recipient_email], html_body=email_html_message, from_email=from_email, kind='subscription_confirmation')
 
 
 def custom_exception_handler(exc, context):
@@ -302,92 +1089,139 @@ def social_user_handler(strategy, details, backend, user=None, *args, **kwargs):
     return {'is_new': user is None, 'user': user}
 
 
-def generate_thank_you_note_pdf(book_purchase, guest_info=None):
+def generate_thank_you_note_pdf(book_purchase, guest_info=None, record_error=True):
     """
     Génère un PDF de note de remerciement, soit comme template soit personnalisé pour un guest
-    
+
+    Le fond (couverture, mise en page, pied de page) est rendu une fois par book purchase et
+    mis en cache ; seul le texte de la note est rendu pour chaque guest puis superposé à la
+    page de la note. Si la note ne tient pas sur sa page, on revient à un rendu complet.
+
     Args:
         book_purchase: L'instance BookPurchase
         guest_info: Optionnel. Si fourni, génère un PDF personnalisé pour ce guest
+        record_error: Enregistre l'échec (ou l'efface après un succès) sur le livre (pdf_error) ;
+            False quand l'appelant enregistre l'échec sur le guest
     """
-    try:
-        if book_purchase.deceased_image:
-            if not os.path.exists(book_purchase.deceased_image.path):
-                raise FileNotFoundError(f"Deceased image file not found: {book_purchase.deceased_image.path}")
+    with PdfRenderStats('thank_you_note', book_purchase=str(book_purchase.id), guest_info=str(guest_info.id) if guest_info else None) as stats:
+        try:
+            if book_purchase.deceased_image:
+                if not os.path.exists(book_purchase.deceased_image.path):
+                    raise FileNotFoundError(f"Deceased image file not found: {book_purchase.deceased_image.path}")
         
-        # Préparer le texte de la note
-        if guest_info:
-            context = {
-                'guest_name': guest_info.guest_name or 'Guest',
-                'guest_address': guest_info.guest_address or '',
-                'guest_email': guest_info.guest_email or '',
-                'deceased_name': book_purchase.deceased_name or '',
+            # Préparer le texte de la note
+            if guest_info:
+                context = {
+                    'guest_name': guest_info.guest_name or 'Guest',
+                    'guest_address': guest_info.guest_address or '',
+                    'guest_email': guest_info.guest_email or '',
+                    'deceased_name': book_purchase.deceased_name or '',
+                    'book_purchaser_name': book_purchase.user.full_name or book_purchase.user.email,
+                }
+                attending_note = substitute_variables(book_purchase.attending_note, context)
+            else:
+                attending_note = book_purchase.attending_note
+
+            # Construire les URLs absolus pour les images, réduites à la taille de leur emplacement
+            with stats.stage('images'):
+                background_image = get_pdf_image(book_purchase.custom_cover or book_purchase.book.cover, 'cover')
+                deceased_image = get_pdf_image(book_purchase.deceased_image, 'portrait')
+            logo_path = os.path.join(settings.BASE_DIR, 'static', 'images', 'logo.png')
+
+            # Contexte pour le template HTML
+            template_context = {
+                'deceased_name': book_purchase.deceased_name,
+                'date_of_birth': book_purchase.date_of_birth.strftime('%B %d, %Y') if book_purchase.date_of_birth else None,
+                'date_of_death': book_purchase.date_of_death.strftime('%B %d, %Y') if book_purchase.date_of_death else None,
+                'attending_note': attending_note,
                 'book_purchaser_name': book_purchase.user.full_name or book_purchase.user.email,
+                'background_image': asset_uri(background_image),
+                'deceased_image': asset_uri(deceased_image),
+                'logo': asset_uri(logo_path),
             }
-            attending_note = substitute_variables(book_purchase.attending_note, context)
-        else:
-            attending_note = book_purchase.attending_note
 
-        # Construire les URLs absolus pour les images
-        background_image = book_purchase.custom_cover.path if book_purchase.custom_cover else book_purchase.book.cover.path
-        deceased_image = book_purchase.deceased_image.path if book_purchase.deceased_image else None
-        logo_path = os.path.join(settings.BASE_DIR, 'static', 'images', 'logo.png')
+            # Fond commun à tous les guests, puis calque du texte personnalisé
+            with stats.stage('background'):
+                base_path = get_thank_you_note_base(book_purchase, template_context, [background_image, deceased_image, logo_path])
+            with stats.stage('template'):
+                text_html = render_to_string('pdf/thank_you_note.html', {**template_context, 'layer': 'text'})
+            with stats.stage('layout'):
+                text_layer = submit_pdf_render(text_html, 'thank_you_note', optimize_size=('fonts', 'images')).result()
 
-        # Contexte pour le template HTML
-        template_context = {
-            'deceased_name': book_purchase.deceased_name,
-            'date_of_birth': book_purchase.date_of_birth.strftime('%B %d, %Y') if book_purchase.date_of_birth else None,
-            'date_of_death': book_purchase.date_of_death.strftime('%B %d, %Y') if book_purchase.date_of_death else None,
-            'attending_note': attending_note,
-            'book_purchaser_name': book_purchase.user.full_name or book_purchase.user.email,
-        }
+            with stats.stage('merge'):
+                pdf = stamp_thank_you_note(base_path, text_layer)
+            stats.fields['full_render'] = pdf is None
+            if pdf is None:
+                # La note déborde de sa page : la mise en page change, rendu complet
+                with stats.stage('template'):
+                    html_string = render_to_string('pdf/thank_you_note.html', template_context)
+                with stats.stage('layout'):
+                    pdf = submit_pdf_render(html_string, 'thank_you_note', optimize_size=('fonts', 'images')).result()
+        except Exception as e:
+            if record_error:
+                record_pdf_error(book_purchase, 'thank_you_note', e)
+            raise
+        if record_error:
+            record_pdf_error(book_purchase, 'thank_you_note')
 
-        # Créer un dossier temporaire pour les assets
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            # Copier les images dans le dossier temporaire
-            tmp_bg = os.path.join(tmpdirname, 'background.jpg')
-            tmp_deceased = os.path.join(tmpdirname, 'deceased.jpg') if deceased_image else None
-            tmp_logo = os.path.join(tmpdirname, 'logo.png')
-            
-            import shutil
-            shutil.copy2(background_image, tmp_bg)
-            if deceased_image:
-                shutil.copy2(deceased_image, tmp_deceased)
-            if os.path.exists(logo_path):
-                shutil.copy2(logo_path, tmp_logo)
-            
-            # Ajouter les chemins d'images au contexte
-            template_context.update({
-                'background_image': tmp_bg,
-                'deceased_image': tmp_deceased,
-                'logo': tmp_logo
-            })
+        stats.output_bytes = len(pdf)
+        return pdf
+
+
+def get_thank_you_note_base(book_purchase, template_context, assets):
+    """
+    Chemin du PDF de fond de la note de remerciement (tout sauf le texte de la note),
+    rendu une fois et mis en cache avec les segments du book purchase.
+    """
+    html_string = render_to_string('pdf/thank_you_note.html', {**template_context, 'attending_note': None, 'layer': 'background'})
+
+    digest = hashlib.sha256(html_string.encode('utf-8'))
+    digest.update(get_pdf_template_version('pdf/thank_you_note.html').encode('utf-8'))
+    for asset in assets:
+        digest.update(file_signature(asset).encode('utf-8'))
+
+    cache_dir = os.path.join(settings.PDF_SEGMENT_CACHE_DIR, str(book_purchase.id))
+    base_name = f'thank_you_{digest.hexdigest()}.pdf'
+    base_path = os.path.join(cache_dir, base_name)
+    if os.path.exists(base_path):
+        return base_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f'{base_path}.{uuid.uuid4().hex}.tmp'
+    try:
+        submit_pdf_render(html_string, 'thank_you_note', tmp_path, optimize_size=('fonts', 'images')).result()
+        os.replace(tmp_path, base_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+    # Supprimer les fonds obsolètes (couverture ou template modifiés)
+    for filename in os.listdir(cache_dir):
+        if filename.startswith('thank_you_') and filename.endswith('.pdf') and filename != base_name:
+            os.unlink(os.path.join(cache_dir, filename))
+
+    return base_path
 
-            # Générer le HTML
-            html_string = render_to_string('pdf/thank_you_note.html', template_context)
-            html_path = os.path.join(tmpdirname, 'output.html')
-            
-            with open(html_path, 'w', encoding='utf-8') as f:
-                f.write(html_string)
-            try:
-                # Générer le PDF
-                pdf_buffer = BytesIO()
-                HTML(filename=html_path, base_url=tmpdirname).write_pdf(
-                    pdf_buffer,
-                    presentational_hints=True,
-                    optimize_size=('fonts', 'images'),
-                )
-                pdf = pdf_buffer.getvalue()
-            finally:
-                if os.path.exists(html_path):
-                    os.unlink(html_path)
-                pdf_buffer.close()
-                
-            return pdf
-
-    except Exception as e:
-        print(f"Error generating PDF: {e}")
-        raise
+
+def stamp_thank_you_note(base_path, text_layer):
+    """
+    Superpose le calque texte à la page de la note du PDF de fond.
+    Renvoie None si le texte ne tient pas sur une page.
+    """
+    text_reader = PdfReader(BytesIO(text_layer))
+    base_reader = PdfReader(base_path)
+    if len(text_reader.pages) != 1 or len(base_reader.pages) <= THANK_YOU_NOTE_PAGE:
+        return None
+
+    writer = PdfWriter(clone_from=base_reader)
+    pdf_buffer = BytesIO()
+    try:
+        writer.pages[THANK_YOU_NOTE_PAGE].merge_page(text_reader.pages[0])
+        writer.write(pdf_buffer)
+        return pdf_buffer.getvalue()
+    finally:
+        writer.close()
+        pdf_buffer.close()
 
 
 def substitute_variables(text, context):
@@ -409,33 +1243,133 @@ def substitute_variables(text, context):
     return text
 
 
-def send_thank_you_email(to_email, subject, context, book_purchase, guest_info):
+def get_thank_you_pdf_url(guest_info):
+    """Lien signé vers le PDF de remerciement du guest, valable THANK_YOU_LINK_MAX_AGE secondes"""
+    token = signing.TimestampSigner(salt=THANK_YOU_PDF_SALT).sign(str(guest_info.pk))
+    path = reverse('guest_infos-download-thank-you-pdf', args=[guest_info.pk])
+    return f"{get_full_url(path)}?{urlencode({'token': token})}"
+
+
+def get_thank_you_context(book_purchase, guest_info):
+    """Contexte de l'email de remerciement d'un guest, avec la note personnalisée"""
+    context = {
+        'guest_name': guest_info.guest_name or 'Guest',
+        'guest_address': guest_info.guest_address or '',
+        'guest_email': guest_info.guest_email or '',
+        'deceased_name': book_purchase.deceased_name or '',
+        'attending_note': book_purchase.attending_note,
+        'book_purchaser_name': (book_purchase.user.full_name or book_purchase.user.email),
+        'guest_id': guest_info.id,
+    }
+    context['attending_note'] = substitute_variables(context['attending_note'], context)
+    if book_purchase.thank_you_delivery == 'link':
+        context['thank_you_pdf_url'] = get_thank_you_pdf_url(guest_info)
+        context['thank_you_pdf_expires'] = timezone.now() + timezone.timedelta(seconds=settings.THANK_YOU_LINK_MAX_AGE)
+    return context
+
+
+def store_thank_you_pdf(guest_info, pdf_content):
     """
-    Envoie un email de remerciement avec le PDF personnalisé
+    Enregistre le PDF personnalisé du guest par une mise à jour ciblée : un save() du guest
+    déclencherait ses signaux (PDF du livre marqué obsolète). Le PDF précédent est supprimé,
+    sauf s'il est encore joint à un email en attente d'envoi.
     """
-    # Générer l'email HTML
-    context['logo_url'] = f'{settings.BASE_URL}{staticfiles_storage.url("images/logo.png")}'
-    context['guest_id'] = guest_info.id
-    email_html_message = render_to_string('email/send_thank_you_guest.html', context)
-    email_plaintext_message = render_to_string('email/send_thank_you_guest.txt', context)
-    
-    # Générer le PDF personnalisé pour ce guest
-    pdf_content = generate_thank_you_note_pdf(book_purchase, guest_info)
-    if guest_info:
-        guest_info.thank_you_pdf.save(f'thank_you_{guest_info.id}.pdf', ContentFile(pdf_content), save=True)
+    from visitationbookapi.models import OutboxAttachment
 
-    try:
-        msg = EmailMultiAlternatives(
+    field_file = guest_info.thank_you_pdf
+    old_name = field_file.name
+    name = field_file.storage.save(field_file.field.generate_filename(guest_info, f'thank_you_{guest_info.id}.pdf'), ContentFile(pdf_content))
+    type(guest_info).objects.filter(pk=guest_info.pk).update(thank_you_pdf=name)
+    guest_info.thank_you_pdf = name
+
+    if old_name and old_name != name and not OutboxAttachment.objects.filter(file=old_name, email__status__in=['queued', 'sending']).exists():
+        field_file.storage.delete(old_name)
+
+
+def queue_thank_you_email(guest_info, subject, body, html_body, attach_pdf=True):
+    """
+    Place dans l'outbox l'email de remerciement du guest. Le PDF déjà stocké sur le guest est
+    joint sans copie ; avec attach_pdf=False, le corps porte un lien signé à la place.
+    """
+    with transaction.atomic():
+        email = queue_email(
             subject,
-            email_plaintext_message,
-            settings.DEFAULT_FROM_EMAIL,
-            [to_email]
+            body,
+            [guest_info.guest_email],
+            html_body=html_body,
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            attachments=[('thank_you_note.pdf', guest_info.thank_you_pdf, 'application/pdf')] if attach_pdf else [],
+            kind='thank_you',
         )
-        msg.attach_alternative(email_html_message, "text/html")
-        msg.attach('thank_you_note.pdf', pdf_content, 'application/pdf')
-        
-        msg.send()
-        return True
-    except Exception as e:
-        print(f"Error sending email: {e}")
-        return False
\ No newline at end of file
+        type(guest_info).objects.filter(pk=guest_info.pk).update(thank_you_status='queued', thank_you_email=email, thank_you_error=None)
+    guest_info.thank_you_status = 'queued'
+    guest_info.thank_you_email = email
+    guest_info.thank_you_error = None
+    return email
+
+
+def record_thank_you_error(guest_info, error):
+    """Enregistre sur le guest l'échec de sa note de remerciement"""
+    logger.error("Error sending thank you note to guest %s: %s", guest_info.id, error)
+    guest_info.thank_you_status = 'failed'
+    guest_info.thank_you_error = str(error)
+    type(guest_info).objects.filter(pk=guest_info.pk).update(thank_you_status='failed', thank_you_error=guest_info.thank_you_error)
+
+
+def send_thank_you_notes(book_purchase, guest_infos):
+    """
+    Envoie la note de remerciement personnalisée à plusieurs guests d'un même livre.
+
+    Les PDF sont rendus en parallèle dans le pool de rendu, les emails rendus en lot puis
+    placés dans l'outbox, que `send_queued_emails` délivre sur une connexion SMTP réutilisée.
+    Le statut de chaque guest passe à `queued` ou `failed` ; renvoie le nombre d'emails
+    placés dans l'outbox.
+    book_purchase est de préférence chargé avec select_related('user', 'book').
+    """
+    guest_infos = list(guest_infos)
+    if not guest_infos:
+        return 0
+    if not book_purchase.attending_note:
+        for guest_info in guest_infos:
+            record_thank_you_error(guest_info, "The book has no thank-you note")
+        return 0
+
+    # L'auteur du livre est chargé ici, une fois pour tous les threads de rendu
+    contexts = [get_thank_you_context(book_purchase, guest_info) for guest_info in guest_infos]
+
+    def render(guest_info):
+        try:
+            # L'échec d'un guest est enregistré sur ce guest seulement, pas sur le livre partagé
+            return generate_thank_you_note_pdf(book_purchase, guest_info, record_error=False)
+        except Exception as e:
+            return e
+        finally:
+            # Chaque thread a sa propre connexion
+            db_connection.close()
+
+    with futures.ThreadPoolExecutor(max_workers=max(settings.PDF_RENDER_POOL_SIZE, 1)) as executor:
+        # Le premier rendu produit le fond commun, mis en cache pour les suivants
+        pdfs = [executor.submit(render, guest_infos[0]).result()]
+        pdfs += executor.map(render, guest_infos[1:])
+
+    rendered = []
+    for guest_info, context, pdf in zip(guest_infos, contexts, pdfs):
+        if isinstance(pdf, Exception):
+            record_thank_you_error(guest_info, pdf)
+            continue
+        try:
+            store_thank_you_pdf(guest_info, pdf)
+        except Exception as e:
+            record_thank_you_error(guest_info, e)
+            continue
+        rendered.append((guest_info, context))
+
+    queued = 0
+    messages = render_emails('send_thank_you_guest', [context for _, context in rendered])
+    for (guest_info, _), (body, html_body) in zip(rendered, messages):
+        try:
+            queue_thank_you_email(guest_info, THANK_YOU_EMAIL_SUBJECT, body, html_body, attach_pdf=book_purchase.thank_you_delivery == 'attachment')
+            queued += 1
+        except Exception as e:
+            record_thank_you_error(guest_info, e)
+    return queued
\ No newline at end of file
@@ -1,5 +1,7 @@
 from visitationbook import settings
 from django.shortcuts import redirect
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
@@ -10,6 +12,7 @@ from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework_simplejwt.tokens import RefreshToken
 from visitationbookapi.models import *
 from visitationbookapi.serializers import *
+from visitationbookapi.utils import render_pdf_metrics
 from allauth.socialaccount.providers.google.views import GoogleOAuth2Adapter
 from allauth.socialaccount.providers.facebook.views import FacebookOAuth2Adapter
 from dj_rest_auth.registration.views import SocialLoginView, SocialAccountDisconnectView
@@ -186,3 +189,16 @@ def get_tokens_for_user(user):
         'refresh': str(refresh),
         'access': str(refresh.access_token),
     }
+
+
+class PdfMetricsView(APIView):
+    """Métriques du pipeline PDF au format Prometheus"""
+    permission_classes = (permissions.AllowAny,)
+    authentication_classes = ()
+
+    def get(self, request):
+        if settings.PDF_METRICS_TOKEN and not constant_time_compare(
+            request.headers.get('Authorization', ''), f'Bearer {settings.PDF_METRICS_TOKEN}'
+        ):
+            return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+        return HttpResponse(render_pdf_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
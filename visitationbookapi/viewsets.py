@@ -1,10 +1,12 @@
 from django.db import transaction
+from django.db.models import Count
 from django.contrib.auth.models import User
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework import viewsets, status, permissions
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.pagination import PageNumberPagination
 from visitationbookapi.models import *
 from visitationbookapi.serializers import *
 from visitationbookapi.permissions import *
@@ -12,10 +14,11 @@ from visitationbookapi.utils import *
 from django_filters.rest_framework import DjangoFilterBackend
 from decimal import Decimal
 import stripe
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
-from email.mime.image import MIMEImage
-from django.contrib.staticfiles.storage import staticfiles_storage
+from django.http import FileResponse
+from django.core import signing
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
 
 
 class UserViewSet(viewsets.ModelViewSet):
@@ -41,6 +44,12 @@ class BookViewSet(viewsets.ReadOnlyModelViewSet):
     authentication_classes = [JWTAuthentication]
 
 
+class PagePagination(PageNumberPagination):
+    # Pagination explicite pour les actions qui en dépendent : DEFAULT_PAGINATION_CLASS
+    # n'est pas toujours appliqué (réglages DRF lus avant REST_FRAMEWORK)
+    page_size = 10
+
+
 class BookPurchaseViewSet(viewsets.ModelViewSet):
     queryset = BookPurchase.objects.all()
     serializer_class = BookPurchaseSerializer
@@ -54,8 +63,21 @@ class BookPurchaseViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         if self.action == 'list' and self.request.user.is_authenticated:
-            return BookPurchase.objects.filter(user=self.request.user)
-        return BookPurchase.objects.all()
+            queryset = BookPurchase.objects.filter(user=self.request.user)
+        else:
+            queryset = BookPurchase.objects.all()
+
+        if self.action in ('list', 'retrieve', 'update', 'partial_update'):
+            # Relations imbriquées dans BookPurchaseSerializer chargées en un nombre constant de requêtes,
+            # quel que soit le nombre de livres et de visiteurs
+            queryset = queryset.select_related(
+                'book',
+                'obituary',
+                'payment_transaction__payment_method',
+                'subscription__plan',
+                'subscription__payment_transaction__payment_method',
+            ).prefetch_related('subscription__plan__features', 'guest_infos')
+        return queryset
 
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -284,6 +306,138 @@ class BookPurchaseViewSet(viewsets.ModelViewSet):
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
             
+    def get_pending_pdf_response(self, book_purchase, profile):
+        """
+        Réponse à renvoyer si le PDF du profil n'est pas prêt : 409 pendant un rendu en
+        cours, sinon 202 avec le job de rendu mis en file. None si le PDF peut être servi.
+        """
+        if book_purchase.can_serve_pdf(profile):
+            return None
+        if is_pdf_render_locked(book_purchase):
+            return Response({"error": "The PDF is being rendered, retry later."}, status=status.HTTP_409_CONFLICT)
+        # Le lecteur attend le fichier : pas de fenêtre de regroupement
+        job = book_purchase.request_pdf_render(profile, immediate=True)
+        return Response(PdfRenderJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['get'])
+    def pdf_status(self, request, pk=None):
+        book_purchase = self.get_object()
+        job = book_purchase.pdf_render_jobs.filter(profile='print').first()
+        web_job = book_purchase.pdf_render_jobs.filter(profile='web').first()
+        storage = book_purchase.pdf_file.storage
+        return Response({
+            "pdf_file": get_full_url(book_purchase.pdf_file.url) if book_purchase.pdf_file else None,
+            "pdf_volumes": [get_full_url(storage.url(name)) for name in get_pdf_volume_names(book_purchase)],
+            "pdf_up_to_date": book_purchase.is_complete and book_purchase.is_pdf_up_to_date(),
+            "job": PdfRenderJobSerializer(job).data if job else None,
+            "web_pdf_file": get_full_url(book_purchase.web_pdf_file.url) if book_purchase.web_pdf_file else None,
+            "web_pdf_volumes": [get_full_url(storage.url(name)) for name in get_pdf_volume_names(book_purchase, 'web')],
+            "web_pdf_up_to_date": book_purchase.is_complete and book_purchase.is_pdf_up_to_date('web'),
+            "web_job": PdfRenderJobSerializer(web_job).data if web_job else None,
+            "pdf_error": book_purchase.pdf_error
+        }, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=['post'])
+    def render_print_pdf(self, request, pk=None):
+        """Demande le rendu du PDF d'impression (ex. à la fin du service)"""
+        book_purchase = self.get_object()
+
+        if not book_purchase.is_complete:
+            return Response({"error": "The book is not complete yet."}, status=status.HTTP_400_BAD_REQUEST)
+
+        job = book_purchase.request_pdf_render('print')
+        return Response(PdfRenderJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['post'])
+    def send_thank_you_notes(self, request, pk=None):
+        """Envoie (ou renvoie, après modification de la note) la note de remerciement à tous les visiteurs ayant un email"""
+        book_purchase = self.get_object()
+
+        if not book_purchase.attending_note:
+            return Response({"error": "The book has no thank-you note."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Rendus et envois faits par `run_pdf_worker` ; l'avancement est suivi via thank_you_notes
+        scheduled = book_purchase.request_thank_you_notes()
+        return Response({"scheduled": scheduled}, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['get'], pagination_class=PagePagination)
+    def thank_you_notes(self, request, pk=None):
+        """Avancement de l'envoi des notes de remerciement : nombre de visiteurs par statut et résultat paginé par visiteur"""
+        book_purchase = self.get_object()
+        guests = book_purchase.guest_infos.filter(thank_you_status__isnull=False)
+
+        counts = dict.fromkeys([choice for choice, _ in GuestInfo.THANK_YOU_STATUS_CHOICES], 0)
+        counts.update(guests.order_by().values_list('thank_you_status').annotate(Count('id')))
+
+        page = self.paginate_queryset(guests.select_related('thank_you_email').order_by('created_at', 'id'))
+        response = self.get_paginated_response(ThankYouNoteStatusSerializer(page, many=True).data)
+        response.data['statuses'] = counts
+        return response
+
+    @action(detail=True, methods=['get'], permission_classes=[permissions.AllowAny], authentication_classes=[])
+    def download_pdf(self, request, pk=None):
+        book_purchase = self.get_object()
+
+        if not book_purchase.is_complete:
+            return Response({"error": "The book is not complete yet."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # ?profile=web : aperçu léger ; par défaut, PDF d'impression
+        profile = request.query_params.get('profile', 'print')
+        if profile not in PDF_PROFILES:
+            return Response({"error": f"Unknown profile: {profile}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Jamais de rendu dans la requête : un PDF obsolète est rendu par `run_pdf_worker`
+        pending = self.get_pending_pdf_response(book_purchase, profile)
+        if pending is not None:
+            return pending
+
+        # ?volume=N pour les livres découpés en volumes (par défaut le premier)
+        volume_names = get_pdf_volume_names(book_purchase, profile)
+        volume = request.query_params.get('volume', '1')
+        if not volume.isdigit():
+            return Response({"error": f"Invalid volume: {volume}"}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= int(volume) <= len(volume_names):
+            return Response({"error": f"Unknown volume: {volume}"}, status=status.HTTP_404_NOT_FOUND)
+
+        suffix = '' if profile == 'print' else f'_{profile}'
+        if len(volume_names) > 1:
+            suffix += f'_vol{volume}'
+        field_file = getattr(book_purchase, PDF_PROFILES[profile]['file_field'])
+        return FileResponse(
+            field_file.storage.open(volume_names[int(volume) - 1], 'rb'),
+            as_attachment=True,
+            filename=f'book_purchase_{book_purchase.id}{suffix}.pdf',
+            content_type='application/pdf'
+        )
+
+    @action(detail=True, methods=['get'], permission_classes=[permissions.AllowAny], authentication_classes=[], pagination_class=PagePagination)
+    def previews(self, request, pk=None):
+        """Vignettes paginées des pages du livre (couverture, pages de visiteurs), sans télécharger le PDF"""
+        book_purchase = self.get_object()
+
+        if not book_purchase.is_complete:
+            return Response({"error": "The book is not complete yet."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Les vignettes sont tirées du PDF web, rendu par `run_pdf_worker` s'il est obsolète
+        pending = self.get_pending_pdf_response(book_purchase, 'web')
+        if pending is not None:
+            return pending
+
+        try:
+            storage = book_purchase.web_pdf_file.storage
+            page_counts = [count_pdf_pages(storage.path(name)) for name in get_pdf_volume_names(book_purchase, 'web')]
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        # Seules les pages de la page de résultats demandée sont rastérisées
+        pages = self.paginate_queryset(list(range(1, sum(page_counts) + 1)))
+        try:
+            previews = get_pdf_previews(book_purchase, pages, page_counts)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        return self.get_paginated_response(previews)
+
     @action(detail=True, methods=['post'], permission_classes=[permissions.AllowAny], authentication_classes=[])
     def increment_visit(self, request, pk=None):
         try:
@@ -304,19 +458,37 @@ class GuestInfoViewSet(viewsets.ModelViewSet):
     serializer_class = GuestInfoSerializer
     permission_classes = [permissions.AllowAny]
     authentication_classes = []
+    # Le rendu du PDF est demandé par le signal post_save de GuestInfo
 
-    def perform_create(self, serializer):
-        guest_info = serializer.save()
-        book_purchase = guest_info.book_purchase
-        if book_purchase.is_complete:
-            update_pdf(book_purchase)
+    @action(detail=True, methods=['get'])
+    def download_thank_you_pdf(self, request, pk=None):
+        """PDF de remerciement du guest, via le lien signé et expirant envoyé par email"""
+        try:
+            guest_id = signing.TimestampSigner(salt=THANK_YOU_PDF_SALT).unsign(request.query_params.get('token', ''), max_age=settings.THANK_YOU_LINK_MAX_AGE)
+        except signing.SignatureExpired:
+            return Response({"error": "This link has expired."}, status=status.HTTP_410_GONE)
+        except signing.BadSignature:
+            return Response({"error": "Invalid link."}, status=status.HTTP_403_FORBIDDEN)
+        if guest_id != str(pk):
+            return Response({"error": "Invalid link."}, status=status.HTTP_403_FORBIDDEN)
+
+        guest_info = self.get_object()
+        field_file = guest_info.thank_you_pdf
+        if not field_file or not field_file.storage.exists(field_file.name):
+            return Response({"error": "The thank you note is not available."}, status=status.HTTP_404_NOT_FOUND)
+
+        # Chaque rendu est stocké sous un nouveau nom : il sert d'ETag, revalidé par le navigateur
+        etag = quote_etag(os.path.basename(field_file.name))
+        # Secondes entières, comme If-Modified-Since : sinon la date ne correspond jamais
+        last_modified = int(field_file.storage.get_modified_time(field_file.name).timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = FileResponse(field_file.storage.open(field_file.name, 'rb'), filename='thank_you_note.pdf', content_type='application/pdf')
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, private=True, max_age=3600)
+        return response
 
-    def perform_update(self, serializer):
-        guest_info = serializer.save()
-        book_purchase = guest_info.book_purchase
-        if book_purchase.is_complete:
-            update_pdf(book_purchase)
-        
 
 class PaymentMethodViewSet(viewsets.ModelViewSet):
     """
@@ -482,6 +654,8 @@ class EmailViewSet(viewsets.ViewSet):
     authentication_classes = [JWTAuthentication]
     
     def create(self, request):
+        # Pièces jointes écrites sur disque à la réception plutôt que gardées en mémoire
+        request.upload_handlers = [TemporaryFileUploadHandler(request)]
         serializer = EmailSerializer(data=request.data)
 
         if serializer.is_valid():
@@ -500,13 +674,10 @@ class EmailViewSet(viewsets.ViewSet):
             if not book_purchase:
                 return Response({"message": "Book Purchase ID is invalid"}, status=status.HTTP_403_FORBIDDEN)
             
-            logo_url = f'{settings.BASE_URL}{staticfiles_storage.url("images/logo.png")}'
-            
             url = "{}admin/visitation-books/send-guest?token={}".format(settings.FRONT_URL, book_purchase.id)
             subject = f"Thank you for attending note for {book_purchase.deceased_name}" if book_purchase.deceased_name != None else "Thank you for attending note"
                 
             context = {
-                'logo_url': logo_url,
                 'url': url,
                 'subject': subject,
                 'message': message,
@@ -515,28 +686,23 @@ class EmailViewSet(viewsets.ViewSet):
                 'attachments': attachments
             }
 
-            email_html_message = render_to_string('email/send_thank_you.html', context)
-            email_plaintext_message = render_to_string('email/send_thank_you.txt', context)
+            email_plaintext_message, email_html_message = render_email('send_thank_you', context)
 
-            msg = EmailMultiAlternatives(
-                subject,
-                email_plaintext_message,
-                from_email,
-                emails_to
-            )
-            msg.attach_alternative(email_html_message, "text/html")
-            
-            if attachments:
-                for attachment in attachments:
-                    img_data = attachment.read()
-                    msg_img = MIMEImage(img_data, _subtype=attachment.content_type.split('/')[1])
-                    msg_img.add_header('Content-ID', f'<{attachment.name}>')
-                    msg_img.add_header('Content-Disposition', 'inline', filename=attachment.name)
-                    msg.attach(msg_img)
-            
             try:
-                msg.send()
-                return Response({"message": "Email sent successfully"}, status=status.HTTP_200_OK)
+                # Images intégrées au corps HTML (cid:<nom du fichier>), réduites une fois pour tous les destinataires
+                inline_images = [(attachment.name, *prepare_email_image(attachment)) for attachment in attachments]
+                queue_email(
+                    subject,
+                    email_plaintext_message,
+                    emails_to,
+                    html_body=email_html_message,
+                    from_email=from_email,
+                    inline_images=inline_images,
+                    kind='thank_you_family',
+                )
+                return Response({"message": "Email queued successfully"}, status=status.HTTP_200_OK)
+            except (EmailMessageTooLarge, Image.DecompressionBombError, render_pool.RenderLimitExceeded) as e:
+                return Response({"error": str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
             except Exception as e:
                 return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 